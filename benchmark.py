@@ -0,0 +1,255 @@
+"""
+Benchmarks the presence pipeline on a single offline box. The ICMP prober is replaced by a simulated
+network with configurable loss and latency, all other components are the real ones.
+
+    python benchmark.py [probe|fanout|http|mcp|all] [--devices 10,100,1000] [--loss 0.05] [--latency-ms 2] [--offline 0.2]
+
+Probe intervals and timeouts are scaled by --scale to keep the runs short. The probe rate cap is scaled
+by 1/scale accordingly, so the probe benchmark runs the real configuration in fast motion.
+"""
+import sys
+import random
+import asyncio
+import logging
+import argparse
+import threading
+import http.client
+from time import monotonic, sleep
+from typing import Dict, Iterable, List
+from probe import ProbeEngine, ProbePolicy, ProbeSchedule
+from presence import IpPresence
+from registry import PresenceRegistry
+
+
+class SimulatedNetwork:
+    """
+    A local fake responder. Online hosts answer an echo request with the configured probability after
+    latency_ms (exponentially distributed around the mean). Offline hosts never answer
+    """
+
+    def __init__(self, loss: float, latency_ms: float):
+        self.loss = loss
+        self.latency_ms = latency_ms
+        self.online: Dict[str, bool] = dict()
+        self.sent = 0
+
+    def ping(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        # same contract as IcmpProber.ping: blocks until all hosts answered or the timeout is reached
+        addrs = list(addrs)
+        self.sent += len(addrs)
+        rtts = {addr: random.expovariate(1000 / self.latency_ms) for addr in addrs if self.online.get(addr, False) and random.random() >= self.loss}
+        rtts = {addr: rtt for addr, rtt in rtts.items() if rtt < timeout}
+        sleep(timeout if len(rtts) < len(addrs) else max(rtts.values(), default=0))
+        return rtts
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def create_presences(network: SimulatedNetwork, devices: int, scale: float, online: bool = True) -> List[IpPresence]:
+    engine = ProbeEngine(prober=network,
+                         policy=ProbePolicy(probe_timeout_sec=3 * scale),
+                         schedule=ProbeSchedule(present_interval_sec=20 * scale,
+                                                boundary_interval_sec=5 * scale,
+                                                absent_interval_sec=5 * scale,
+                                                max_interval_sec=60 * scale,
+                                                max_probes_per_sec=ProbeSchedule().max_probes_per_sec / scale))
+    presences = []
+    for i in range(devices):
+        addr = "10.0." + str(i // 250) + "." + str(i % 250 + 1)
+        network.online[addr] = online
+        presences.append(IpPresence("device" + str(i), addr, int(180 * scale), engine=engine))
+    return presences
+
+
+def bench_probe(devices: int, args):
+    """
+    probe throughput, the time to determine the initial state and the latency to detect arriving devices,
+    while some hosts stay offline
+    """
+    network = SimulatedNetwork(args.loss, args.latency_ms)
+    presences = create_presences(network, devices, args.scale)
+    offline = random.sample(presences, max(1, int(devices * args.offline)))
+    for presence in offline:
+        network.online[presence.addr] = False
+    start = monotonic()
+    [presence.start() for presence in presences]
+    while not all(presence.is_known for presence in presences):
+        sleep(0.01)
+    initial_elapsed = monotonic() - start
+
+    # let half of the offline devices arrive and measure the time until they are reported as present.
+    # The others stay offline, so that the probe steps keep waiting for their timeouts
+    arrived = offline[:max(1, len(offline) // 2)]
+    detected: Dict[str, float] = dict()
+    for presence in arrived:
+        presence.add_listener(lambda name: detected.setdefault(name, monotonic()))
+    probed: Dict[str, List[float]] = dict()
+    for presence in presences:
+        if presence not in offline:
+            presence.add_listener(lambda name: probed.setdefault(name, []).append(monotonic()), heartbeat=True)
+    sent_before, start = network.sent, monotonic()
+    for presence in arrived:
+        network.online[presence.addr] = True
+    while (len(detected) < len(arrived) or monotonic() - start < args.duration) and monotonic() - start < args.duration * 10:
+        sleep(0.01)
+    elapsed = monotonic() - start
+    latencies = [detected[presence.name] - start for presence in arrived if presence.name in detected]
+    intervals = [later - earlier for times in probed.values() for earlier, later in zip(times, times[1:])]
+    [presence.stop() for presence in presences]
+    print(f"probe   devices={devices:5d}  offline={len(offline) - len(arrived)}  echo requests/s={(network.sent - sent_before) / elapsed:9.1f}  "
+          f"initial state={initial_elapsed:.2f}s  detected={len(latencies)}/{len(arrived)}  arrival latency p50={percentile(latencies, 50):.2f}s "
+          f"p95={percentile(latencies, 95):.2f}s p99={percentile(latencies, 99):.2f}s  present probe interval p50={percentile(intervals, 50):.2f}s "
+          f"p99={percentile(intervals, 99):.2f}s  (scale {args.scale})")
+
+
+def toggle_all(presences: List[IpPresence], rounds: int) -> float:
+    # toggles the state of all devices by injected probe results and returns the time spent
+    start = monotonic()
+    for i in range(rounds):
+        for presence in presences:
+            if presence.is_presence:
+                # let the device time out without waiting for it
+                presence.table.last_seen[presence.slot] -= presence.timeout_sec + 1
+                presence.table.last_seen_mono[presence.slot] -= presence.timeout_sec + 1
+                presence.on_probe_result(None)
+            else:
+                presence.on_probe_result(0.001)
+    return monotonic() - start
+
+
+def bench_fanout(devices: int, args):
+    """
+    cost of a state transition passing the registry, PresenceThing and PresenceMCPServer
+    """
+    import tornado.ioloop
+    from presence_thing import PresenceThing, ThingPublisher
+    from presence_mcp import PresenceMCPServer
+
+    network = SimulatedNetwork(args.loss, args.latency_ms)
+    presences = create_presences(network, devices, args.scale)
+    [presence.on_probe_result(0.001) for presence in presences]
+    registry = PresenceRegistry(presences)
+    baseline = toggle_all(presences, 2)
+
+    ioloop = tornado.ioloop.IOLoop.current()
+    ThingPublisher(registry, [PresenceThing("benchmark", presence, registry) for presence in presences])
+    mcp_server = PresenceMCPServer("benchmark", 0, registry)
+
+    class FakeSession:
+        def __init__(self):
+            self.updates = 0
+
+        async def send_resource_updated(self, uri) -> None:
+            await asyncio.sleep(args.latency_ms / 1000)
+            self.updates += 1
+
+    sessions = [FakeSession() for i in range(args.sessions)]
+    mcp_server.active_sessions.update(sessions)
+    threading.Thread(target=mcp_server.loop.run_forever, daemon=True).start()
+
+    transitions = devices
+    elapsed = toggle_all(presences, 1)
+    ioloop_start = monotonic()
+    ioloop.run_sync(lambda: asyncio.sleep(0))    # drain the queued webthing callbacks
+    ioloop_elapsed = monotonic() - ioloop_start
+    while sum(session.updates for session in sessions) < transitions * len(sessions) and monotonic() - ioloop_start < args.duration * 10:
+        sleep(0.01)
+    mcp_elapsed = monotonic() - ioloop_start
+    mcp_server.loop.call_soon_threadsafe(mcp_server.loop.stop)
+    print(f"fanout  devices={devices:5d}  transitions={transitions}  listener fan-out={(elapsed - baseline / 2) / transitions * 1e6:8.1f}us/transition  "
+          f"webthing ioloop={ioloop_elapsed / transitions * 1e6:8.1f}us/transition  "
+          f"mcp updates delivered to {len(sessions)} sessions after {mcp_elapsed:.2f}s")
+
+
+def bench_http(devices: int, args):
+    """
+    request throughput and latency of the HTTP server with keep-alive clients
+    """
+    from presence_web import PresenceWebServer
+
+    network = SimulatedNetwork(args.loss, args.latency_ms)
+    presences = create_presences(network, devices, args.scale)
+    [presence.on_probe_result(0.001) for presence in presences]
+    registry = PresenceRegistry(presences)
+    web_server = PresenceWebServer(registry, host="127.0.0.1", port=args.port)
+    web_server.start()
+    latencies: List[float] = []
+    lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection("127.0.0.1", args.port)
+        local_latencies = []
+        end = monotonic() + args.duration
+        while monotonic() < end:
+            start = monotonic()
+            connection.request("GET", "/" + random.choice(presences).name)
+            connection.getresponse().read()
+            local_latencies.append(monotonic() - start)
+        with lock:
+            latencies.extend(local_latencies)
+
+    clients = [threading.Thread(target=client) for i in range(args.clients)]
+    [thread.start() for thread in clients]
+    [thread.join() for thread in clients]
+    web_server.stop()
+    print(f"http    devices={devices:5d}  clients={args.clients}  requests/s={len(latencies) / args.duration:9.1f}  "
+          f"p50={percentile(latencies, 50) * 1000:.2f}ms p99={percentile(latencies, 99) * 1000:.2f}ms")
+
+
+def bench_mcp(devices: int, args):
+    """
+    resource read throughput of the MCP server by an in-memory client (without transport overhead)
+    """
+    from fastmcp import Client
+    from presence_mcp import PresenceMCPServer
+
+    network = SimulatedNetwork(args.loss, args.latency_ms)
+    presences = create_presences(network, devices, args.scale)
+    [presence.on_probe_result(0.001) for presence in presences]
+    registry = PresenceRegistry(presences)
+    mcp_server = PresenceMCPServer("benchmark", 0, registry)
+
+    async def run() -> List[float]:
+        latencies = []
+        async with Client(mcp_server.mcp) as client:
+            end = monotonic() + args.duration
+            while monotonic() < end:
+                start = monotonic()
+                await client.read_resource("sensor://presence/" + random.choice(presences).name)
+                latencies.append(monotonic() - start)
+        return latencies
+
+    latencies = asyncio.run(run())
+    print(f"mcp     devices={devices:5d}  resource reads/s={len(latencies) / args.duration:9.1f}  "
+          f"p50={percentile(latencies, 50) * 1000:.2f}ms p99={percentile(latencies, 99) * 1000:.2f}ms")
+
+
+BENCHMARKS = {"probe": bench_probe, "fanout": bench_fanout, "http": bench_http, "mcp": bench_mcp}
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.WARNING, datefmt='%Y-%m-%d %H:%M:%S')
+    parser = argparse.ArgumentParser(description="benchmarks the presence pipeline with a simulated network")
+    parser.add_argument("benchmark", nargs="?", default="all", choices=list(BENCHMARKS.keys()) + ["all"])
+    parser.add_argument("--devices", default="10,100,1000", help="comma separated device counts")
+    parser.add_argument("--loss", type=float, default=0.05, help="echo request loss ratio")
+    parser.add_argument("--latency-ms", type=float, default=2, help="mean echo round trip time")
+    parser.add_argument("--scale", type=float, default=0.1, help="factor applied to all probe intervals and timeouts (the probe rate cap is divided by it)")
+    parser.add_argument("--offline", type=float, default=0.2, help="ratio of the devices which are offline. Half of them arrive while measuring")
+    parser.add_argument("--duration", type=float, default=5, help="measuring time (sec) of the throughput benchmarks")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument("--sessions", type=int, default=10, help="simulated MCP sessions")
+    parser.add_argument("--port", type=int, default=18344, help="local port of the HTTP benchmark")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    for name, benchmark in BENCHMARKS.items():
+        if args.benchmark in (name, "all"):
+            for devices in [int(count) for count in args.devices.split(",")]:
+                benchmark(devices, args)
+    sys.exit(0)
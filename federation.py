@@ -0,0 +1,242 @@
+import json
+import random
+import hashlib
+import logging
+import http.client
+from time import sleep, monotonic, time
+from threading import Thread, Lock, Condition
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+from presence import Presence, EPOCH, from_ts
+from metrics import REGISTRY, Counter, Gauge
+
+
+FEDERATION_UPDATES = REGISTRY.register(Counter("presence_federation_updates_total", "presence updates received from peer nodes", ("peer",)))
+
+
+class FederatedPresence(Presence):
+    """
+    A device shared by all nodes of the federation. Only the nodes selected by the federation probe the
+    device by the local presence. The other nodes merge the updates received from them. The latest last
+    seen time wins. The transitions are logged by the federated presence only, not by the local one
+    """
+
+    def __init__(self, local: Presence):
+        self.__local = local
+        local.suppress_log()
+        self.__lock = Lock()
+        self.__remote_last_seen = EPOCH
+        self.__remote_is_known = False
+        self.__is_probing = False
+        self.__is_started = False
+        super().__init__(local.name, local.addr, local.timeout_sec)
+        local.add_listener(self._notify_listeners, heartbeat=True)
+
+    @property
+    def local(self) -> Presence:
+        return self.__local
+
+    @property
+    def is_probing(self) -> bool:
+        return self.__is_probing
+
+    @property
+    def last_time_presence(self) -> datetime:
+        return max(self.__local.last_time_presence, self.__remote_last_seen)
+
+    @property
+    def last_seen_mono(self) -> float:
+        remote_last_seen_mono = monotonic() - (datetime.utcnow() - self.__remote_last_seen).total_seconds()
+        return max(self.__local.last_seen_mono, remote_last_seen_mono)
+
+    @property
+    def is_known(self) -> bool:
+        return self.__remote_is_known or (self.__is_probing and self.__local.is_known)
+
+    def on_remote_update(self, last_seen: datetime, is_known: bool):
+        with self.__lock:
+            if last_seen > self.__remote_last_seen:
+                self.__remote_last_seen = last_seen
+            self.__remote_is_known = self.__remote_is_known or is_known
+        self._notify_listeners(self.name)
+
+    def set_probing(self, is_probing: bool):
+        with self.__lock:
+            if is_probing == self.__is_probing:
+                return
+            self.__is_probing = is_probing
+            if self.__is_started:
+                self.__local.start() if is_probing else self.__local.stop()
+
+    def start(self):
+        with self.__lock:
+            self.__is_started = True
+            if self.__is_probing:
+                self.__local.start()
+
+    def stop(self):
+        with self.__lock:
+            self.__is_started = False
+            if self.__is_probing:
+                self.__local.stop()
+
+
+class PresenceFederation:
+    """
+    Partitions the probing of the devices across several nodes and exchanges the probe results.
+    The nodes may see different network segments (e.g. one node per VLAN or site), so a device is
+    owned by a node which can reach it: a reachable node that got an answer from the device within its
+    absence timeout. If several nodes did, the owner is selected among them by rendezvous hashing, and
+    the others stop probing. If no node got an answer (e.g. on startup, or after the device left the
+    segment of its owner), all nodes probe the device until one of them gets an answer.
+    If a node is not reachable, its devices are taken over by the remaining nodes.
+
+    The results are exchanged by long polling the HTTP server of the peers (/federation). A response
+    contains the devices probed by the responding node which have changed since the version
+    requested, i.e. only a delta
+    """
+
+    def __init__(self, node: str, peers: List[str], wait_sec: int = 20, peer_timeout_sec: int = 60):
+        self.node = node
+        self.peers = [peer for peer in peers if peer != node]
+        self.__wait_sec = wait_sec
+        self.__peer_timeout_sec = peer_timeout_sec
+        self.__epoch = str(random.getrandbits(48))      # changes on restart to invalidate the versions known by the peers
+        self.__lock = Lock()
+        self.__changed = Condition(self.__lock)
+        self.__version = 0
+        self.__versions: Dict[str, int] = dict()        # name -> version of the last local change
+        self.__published: Dict[str, Tuple[float, bool]] = dict()
+        self.__answered: Dict[str, Dict[str, float]] = dict()    # name -> peer -> last answer of the device to the peer (UTC epoch seconds)
+        self.__presences: Dict[str, FederatedPresence] = dict()
+        # peers are considered as reachable until the first contact timed out, to avoid a takeover on startup
+        self.__last_contact: Dict[str, float] = {peer: monotonic() for peer in self.peers}
+        self.__live_nodes: Tuple[str, ...] = ()
+        self.__is_running = False
+        self.__listeners = ()
+        REGISTRY.register(Gauge("presence_federation_live_nodes", "reachable nodes of the federation, including this node", lambda: len(self.__live_nodes)))
+
+    def federate(self, presence: Presence) -> FederatedPresence:
+        federated = FederatedPresence(presence)
+        self.__presences[federated.name] = federated
+        presence.add_listener(lambda name: self.__on_local_changed(federated), heartbeat=True)
+        self.__rebalance()
+        return federated
+
+    def add_listener(self, listener):
+        """
+        listeners are called with the device name on each local change, i.e. if a delta is available
+        """
+        self.__listeners = self.__listeners + (listener,)
+
+    def forget(self, presence: FederatedPresence):
+        if self.__presences.get(presence.name, None) is presence:
+            self.__presences.pop(presence.name)
+            with self.__lock:
+                self.__answered.pop(presence.name, None)
+
+    @staticmethod
+    def owner(name: str, nodes: Tuple[str, ...]) -> str:
+        return max(nodes, key=lambda node: hashlib.sha1((node + "/" + name).encode("utf-8")).digest())
+
+    def reaching_nodes(self, presence: FederatedPresence, nodes: Tuple[str, ...]) -> Tuple[str, ...]:
+        """
+        returns the nodes which got an answer from the device within its absence timeout
+        """
+        now = time()
+        answered = self.__answered.get(presence.name, {})
+        return tuple(node for node in nodes
+                     if now - (presence.local.last_seen_ts if node == self.node else answered.get(node, 0)) < presence.timeout_sec)
+
+    def __assign(self, presence: FederatedPresence, live_nodes: Tuple[str, ...]):
+        reaching = self.reaching_nodes(presence, live_nodes)
+        presence.set_probing(not reaching or self.owner(presence.name, reaching) == self.node)
+
+    def __rebalance(self):
+        now = monotonic()
+        live_nodes = tuple(sorted([self.node] + [peer for peer in self.peers if now - self.__last_contact[peer] < self.__peer_timeout_sec]))
+        if live_nodes != self.__live_nodes:
+            if self.__live_nodes:
+                logging.info("federation nodes changed to " + ", ".join(live_nodes))
+            self.__live_nodes = live_nodes
+        for presence in list(self.__presences.values()):
+            self.__assign(presence, live_nodes)
+
+    def __on_local_changed(self, presence: FederatedPresence):
+        if not presence.is_probing:
+            return
+        state = (presence.local.last_seen_ts, presence.local.is_known)
+        with self.__lock:
+            if self.__published.get(presence.name, None) == state:
+                return
+            self.__published[presence.name] = state
+            self.__version += 1
+            self.__versions[presence.name] = self.__version
+            self.__changed.notify_all()
+        [listener(presence.name) for listener in self.__listeners]
+        # an answer may make this node the owner, so that the other nodes stop probing the device
+        self.__assign(presence, self.__live_nodes or (self.node,))
+
+    def delta(self, epoch: str, since: int, wait_sec: float) -> Dict:
+        """
+        returns the local changes after the given version. Blocks until a change occurs or the wait time is elapsed
+        """
+        with self.__lock:
+            if epoch != self.__epoch:
+                since = 0
+            self.__changed.wait_for(lambda: self.__version > since, min(wait_sec, self.__wait_sec * 2))
+            states = [[name] + list(self.__published[name]) for name, version in self.__versions.items() if version > since]
+            return {"node": self.node, "epoch": self.__epoch, "version": self.__version, "states": states}
+
+    def start(self):
+        self.__is_running = True
+        for peer in self.peers:
+            Thread(target=self.__pull_loop, args=(peer,), name="federation-" + peer, daemon=True).start()
+        Thread(target=self.__liveness_loop, daemon=True).start()
+        logging.info("federation node " + self.node + " started (peers: " + ", ".join(self.peers) + ")")
+
+    def stop(self):
+        self.__is_running = False
+
+    def __merge(self, peer: str, delta: Dict):
+        for name, last_seen_ts, is_known in delta["states"]:
+            presence = self.__presences.get(name, None)
+            if presence is not None:
+                with self.__lock:
+                    self.__answered.setdefault(name, dict())[peer] = last_seen_ts
+                presence.on_remote_update(from_ts(last_seen_ts), is_known)
+        FEDERATION_UPDATES.inc(peer, amount=len(delta["states"]))
+
+    def __pull_loop(self, peer: str):
+        host, port = peer.rsplit(":", 1)
+        epoch, version = "", 0
+        connection: Optional[http.client.HTTPConnection] = None
+        while self.__is_running:
+            try:
+                if connection is None:
+                    connection = http.client.HTTPConnection(host, int(port), timeout=self.__wait_sec + 10)
+                connection.request("GET", "/federation?epoch=" + epoch + "&since=" + str(version) + "&wait=" + str(self.__wait_sec))
+                response = connection.getresponse()
+                body = response.read()
+                if response.status != 200:
+                    raise IOError("status " + str(response.status))
+                delta = json.loads(body)
+                epoch, version = delta["epoch"], delta["version"]
+                self.__merge(peer, delta)
+                self.__last_contact[peer] = monotonic()
+                self.__rebalance()
+            except Exception as e:
+                logging.debug("federation peer " + peer + " not reachable " + str(e))
+                if connection is not None:
+                    connection.close()
+                    connection = None
+                sleep(5)
+
+    def __liveness_loop(self):
+        # detects peers whose contact has timed out
+        while self.__is_running:
+            sleep(self.__peer_timeout_sec / 4)
+            try:
+                self.__rebalance()
+            except Exception as e:
+                logging.warning("error occurred on rebalancing " + str(e), exc_info=True)
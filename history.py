@@ -0,0 +1,102 @@
+import sqlite3
+import logging
+from time import sleep
+from threading import Thread, Lock
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+from presence import Presence, to_ts, from_ts
+
+
+class PresenceHistory:
+    """
+    Append-only log of the presence transitions plus the last seen time of each device, stored in SQLite.
+    Observed changes are buffered and written in batches. Transitions older than the retention period are
+    dropped, so the log is bounded
+    """
+
+    def __init__(self, filename: str, retention_days: int = 365, flush_interval_sec: int = 15):
+        self.filename = filename
+        self.__retention_days = retention_days
+        self.__flush_interval_sec = flush_interval_sec
+        self.__lock = Lock()
+        self.__pending_transitions: List[Tuple[str, float, int, float]] = []
+        self.__pending_last_seen: Dict[str, float] = dict()
+        self.__last_transitions: Dict[str, int] = dict()       # name -> is_presence of the last recorded transition
+        self.__is_running = True
+        self.__conn = sqlite3.connect(filename, check_same_thread=False)
+        with self.__conn:
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS transitions (name TEXT NOT NULL, time REAL NOT NULL, is_presence INTEGER NOT NULL, last_seen REAL NOT NULL)")
+            self.__conn.execute("CREATE INDEX IF NOT EXISTS transitions_name_time ON transitions (name, time)")
+            self.__conn.execute("CREATE TABLE IF NOT EXISTS last_seen (name TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+        Thread(target=self.__flush_loop, daemon=True).start()
+
+    def observe(self, presence: Presence):
+        with self.__lock:
+            if presence.name not in self.__last_transitions:
+                row = self.__conn.execute("SELECT is_presence FROM transitions WHERE name = ? ORDER BY time DESC LIMIT 1", (presence.name,)).fetchone()
+                if row is not None:
+                    self.__last_transitions[presence.name] = row[0]
+        presence.add_listener(lambda name: self.__on_transition(presence))
+        presence.add_listener(lambda name: self.__on_heartbeat(presence), heartbeat=True)
+
+    def __on_transition(self, presence: Presence):
+        is_presence = 1 if presence.is_presence else 0
+        with self.__lock:
+            # e.g. the first state determined after a restart, which equals the state before
+            if self.__last_transitions.get(presence.name, None) == is_presence:
+                return
+            self.__last_transitions[presence.name] = is_presence
+            self.__pending_transitions.append((presence.name, to_ts(datetime.utcnow()), is_presence, to_ts(presence.last_time_presence)))
+
+    def __on_heartbeat(self, presence: Presence):
+        with self.__lock:
+            self.__pending_last_seen[presence.name] = to_ts(presence.last_time_presence)
+
+    def last_seen(self, name: str) -> Optional[datetime]:
+        with self.__lock:
+            ts = self.__pending_last_seen.get(name, None)
+            if ts is None:
+                row = self.__conn.execute("SELECT last_seen FROM last_seen WHERE name = ?", (name,)).fetchone()
+                ts = None if row is None else row[0]
+        return None if ts is None else from_ts(ts)
+
+    def transitions(self, name: str, since: datetime) -> List[Tuple[datetime, bool]]:
+        """
+        returns the (time, is_presence) transitions of the device since the given UTC time, oldest first
+        """
+        self.flush()
+        with self.__lock:
+            rows = self.__conn.execute("SELECT time, is_presence FROM transitions WHERE name = ? AND time >= ? ORDER BY time", (name, to_ts(since))).fetchall()
+        return [(from_ts(time), is_presence == 1) for time, is_presence in rows]
+
+    def flush(self):
+        with self.__lock:
+            transitions, self.__pending_transitions = self.__pending_transitions, []
+            last_seen, self.__pending_last_seen = self.__pending_last_seen, dict()
+            if transitions or last_seen:
+                with self.__conn:
+                    self.__conn.executemany("INSERT INTO transitions (name, time, is_presence, last_seen) VALUES (?, ?, ?, ?)", transitions)
+                    self.__conn.executemany("INSERT INTO last_seen (name, last_seen) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET last_seen = MAX(last_seen, excluded.last_seen)", last_seen.items())
+
+    def __purge(self):
+        with self.__lock:
+            with self.__conn:
+                self.__conn.execute("DELETE FROM transitions WHERE time < ?", (to_ts(datetime.utcnow() - timedelta(days=self.__retention_days)),))
+
+    def __flush_loop(self):
+        flushes = 0
+        while self.__is_running:
+            sleep(self.__flush_interval_sec)
+            try:
+                self.flush()
+                flushes += 1
+                if flushes % 240 == 0:
+                    self.__purge()
+            except Exception as e:
+                logging.warning("error occurred on writing history " + str(e), exc_info=True)
+
+    def close(self):
+        self.__is_running = False
+        self.flush()
+        with self.__lock:
+            self.__conn.close()
@@ -0,0 +1,137 @@
+import os
+import resource
+from threading import Lock
+from typing import Callable, Dict, List, Tuple
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels_str(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [name + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"') + '"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return ("{" + ",".join(pairs) + "}") if pairs else ""
+
+
+class Metric:
+
+    def __init__(self, name: str, description: str, metric_type: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.metric_type = metric_type
+        self.label_names = label_names
+        self._lock = Lock()
+
+    def render(self) -> List[str]:
+        return ["# HELP " + self.name + " " + self.description, "# TYPE " + self.name + " " + self.metric_type] + self._samples()
+
+    def _samples(self) -> List[str]:
+        return []
+
+
+class Counter(Metric):
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = ()):
+        super().__init__(name, description, "counter", label_names)
+        self.__values: Dict[Tuple[str, ...], float] = dict()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self.__values[label_values] = self.__values.get(label_values, 0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [self.name + _labels_str(self.label_names, labels) + " " + str(value) for labels, value in self.__values.items()]
+
+
+class Gauge(Metric):
+    """
+    a gauge without labels, which reads its value from the supplier on rendering
+    """
+
+    def __init__(self, name: str, description: str, supplier: Callable[[], float]):
+        super().__init__(name, description, "gauge")
+        self.__supplier = supplier
+
+    def _samples(self) -> List[str]:
+        return [self.name + " " + str(self.__supplier())]
+
+
+class Histogram(Metric):
+
+    def __init__(self, name: str, description: str, label_names: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, "histogram", label_names)
+        self.__buckets = buckets
+        self.__values: Dict[Tuple[str, ...], List] = dict()    # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value: float, *label_values: str):
+        with self._lock:
+            values = self.__values.get(label_values, None)
+            if values is None:
+                values = [0] * (len(self.__buckets) + 2)
+                self.__values[label_values] = values
+            for idx, bound in enumerate(self.__buckets):
+                if value <= bound:
+                    values[idx] += 1
+                    break
+            values[-2] += value
+            values[-1] += 1
+
+    def _samples(self) -> List[str]:
+        samples = []
+        with self._lock:
+            for labels, values in self.__values.items():
+                cumulated = 0
+                for idx, bound in enumerate(self.__buckets):
+                    cumulated += values[idx]
+                    samples.append(self.name + "_bucket" + _labels_str(self.label_names, labels, 'le="' + str(bound) + '"') + " " + str(cumulated))
+                samples.append(self.name + "_bucket" + _labels_str(self.label_names, labels, 'le="+Inf"') + " " + str(values[-1]))
+                samples.append(self.name + "_sum" + _labels_str(self.label_names, labels) + " " + str(values[-2]))
+                samples.append(self.name + "_count" + _labels_str(self.label_names, labels) + " " + str(values[-1]))
+        return samples
+
+
+class MetricsRegistry:
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__metrics: Dict[str, Metric] = dict()
+
+    def register(self, metric: Metric):
+        with self.__lock:
+            self.__metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        with self.__lock:
+            self.__metrics.pop(name, None)
+
+    def render(self) -> str:
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+# the process wide registry, rendered by the /metrics endpoint of the web server
+REGISTRY = MetricsRegistry()
+
+
+def process_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024     # the peak, if statm is not available
+
+
+def process_age_sec() -> float:
+    # time since the start of the process, including the interpreter startup and the imports
+    with open("/proc/self/stat") as file:
+        start_ticks = int(file.read().rsplit(")", 1)[1].split()[19])
+    with open("/proc/uptime") as file:
+        uptime_sec = float(file.read().split()[0])
+    return uptime_sec - start_ticks / os.sysconf("SC_CLK_TCK")
+
+
+REGISTRY.register(Gauge("process_resident_memory_bytes", "resident memory size of the process", process_rss_bytes))
@@ -1,43 +1,159 @@
+import re
 import logging
-from threading import Thread
-from time import sleep
+from threading import Thread, Lock, Timer
+from time import sleep, monotonic, time
+from array import array
 from datetime import datetime, timedelta, UTC
 from abc import ABC, abstractmethod
-from typing import List
-from scapy.all import IP, ICMP, sr1
+from typing import Callable, List, Optional, Dict, Set
+from weakref import WeakSet
+from probe import ProbeEngine, default_probe_engine
+from metrics import REGISTRY, Histogram
 
 
+EPOCH = datetime(1970, 1, 1)
+NEVER_SEC = 365 * 24 * 60 * 60      # the age of a presence, which has never been seen
+
+
+def to_ts(utc: datetime) -> float:
+    """
+    converts a (naive) UTC datetime to UTC epoch seconds
+    """
+    return (utc - EPOCH).total_seconds()
+
+
+def from_ts(ts: float) -> datetime:
+    return EPOCH + timedelta(seconds=ts)
+
+MAC_ADDR = re.compile(r"^([0-9a-f]{2}:){5}[0-9a-f]{2}$", re.IGNORECASE)
+
+LISTENER_FANOUT = REGISTRY.register(Histogram("presence_listener_fanout_seconds", "time spent calling the listeners of a notification", ("kind",)))
+
+# guards the reported state of all presences. The critical section is a compare-and-set only, so a
+# shared lock is used instead of a lock per presence
+_reported_lock = Lock()
+
+# presences whose transitions are logged by a wrapping presence (see Presence.suppress_log)
+_unlogged: "WeakSet[Presence]" = WeakSet()
+
+
+
+class DebouncedListener:
+    """
+    Coalesces the notifications received within the debounce period into a single (trailing) call, which
+    receives the notified names. A single timer is pending at most, no matter how many names are notified
+    """
+
+    def __init__(self, listener: Callable[[Set[str]], None], debounce_sec: float):
+        self.__listener = listener
+        self.__debounce_sec = debounce_sec
+        self.__lock = Lock()
+        self.__pending_names: Set[str] = set()
+
+    def __call__(self, name: str):
+        with self.__lock:
+            is_scheduled = len(self.__pending_names) > 0
+            self.__pending_names.add(name)
+        if not is_scheduled:
+            timer = Timer(self.__debounce_sec, self.__flush)
+            timer.daemon = True
+            timer.start()
+
+    def __flush(self):
+        with self.__lock:
+            names, self.__pending_names = self.__pending_names, set()
+        self.__listener(names)
+
 
 class Presence(ABC):
 
+    # the listeners are kept as tuples. Most presences have a few listeners only, which are rarely changed
+    __slots__ = ("name", "addr", "timeout_sec", "__reported_present", "__listeners", "__heartbeat_listeners", "__weakref__")
+
     def __init__(self, name: str, addr: str, timeout_sec: int):
         self.name = name
         self.addr = addr
         self.timeout_sec = timeout_sec
-        self.__reported_present = None
-        self.__listeners = set()
+        # a restored state counts as reported. Otherwise each restart would report a transition
+        self.__reported_present = self.is_presence if self.is_known else None
+        self.__listeners = ()
+        self.__heartbeat_listeners = ()
+
+    def add_listener(self, listener, heartbeat: bool = False):
+        """
+        listeners are called if the presence state changes. Heartbeat listeners are called after
+        each check of the presence (e.g. each probe round), no matter if the state has changed or not
+        """
+        if heartbeat:
+            if listener not in self.__heartbeat_listeners:
+                self.__heartbeat_listeners = self.__heartbeat_listeners + (listener,)
+        else:
+            if listener not in self.__listeners:
+                self.__listeners = self.__listeners + (listener,)
+
+    def remove_listener(self, listener, heartbeat: bool = False):
+        if heartbeat:
+            self.__heartbeat_listeners = tuple(registered for registered in self.__heartbeat_listeners if registered != listener)
+        else:
+            self.__listeners = tuple(registered for registered in self.__listeners if registered != listener)
 
-    def add_listener(self, listener):
-        self.__listeners.add(listener)
+    def suppress_log(self):
+        """
+        stops logging the transitions of this presence, e.g. if they are logged by a presence wrapping it
+        """
+        _unlogged.add(self)
 
     def _notify_listeners(self, name: str):
-        [listener(name) for listener in self.__listeners]
-        if self.is_presence != self.__reported_present:
-            self.__reported_present = self.is_presence
-            logging.info((self.name + " (" + str(self.addr) + ") is presence") if self.is_presence else (self.name + " (" + str(self.addr) + ") is absent"))
+        # notifications may run concurrently (e.g. probe steps and the debounce timer of a group).
+        # The state is checked and updated atomically, so each transition is reported once
+        with _reported_lock:
+            is_presence = self.is_presence if self.is_known else None
+            is_transition = is_presence != self.__reported_present
+            self.__reported_present = is_presence
+        if is_transition:
+            if is_presence is not None and self not in _unlogged:
+                logging.info((self.name + " (" + str(self.addr) + ") is presence") if is_presence else (self.name + " (" + str(self.addr) + ") is absent"))
+            start = monotonic()
+            [listener(name) for listener in self.__listeners]
+            LISTENER_FANOUT.observe(monotonic() - start, "state")
+        start = monotonic()
+        [listener(name) for listener in self.__heartbeat_listeners]
+        LISTENER_FANOUT.observe(monotonic() - start, "heartbeat")
 
     @property
     @abstractmethod
     def last_time_presence(self) -> datetime:
         pass
 
+    @property
+    def last_seen_ts(self) -> float:
+        """
+        the last time presence as UTC epoch seconds
+        """
+        return to_ts(self.last_time_presence)
+
+    @property
+    def last_seen_mono(self) -> float:
+        """
+        the last time presence on the monotonic clock, which is used for the state checks. Presences which do
+        not track it derive it from the wall clock
+        """
+        return monotonic() - (time() - self.last_seen_ts)
+
     @property
     def is_presence(self) -> bool:
-        return (datetime.utcnow() - self.last_time_presence).total_seconds() < self.timeout_sec
+        return monotonic() - self.last_seen_mono < self.timeout_sec
+
+    @property
+    def is_known(self) -> bool:
+        """
+        false, as long as the presence state has not been determined (e.g. before the first probe round)
+        """
+        return True
 
     @property
     def age_sec(self) -> int:
-        return int((datetime.utcnow() - self.last_time_presence).total_seconds())
+        return int(monotonic() - self.last_seen_mono)
 
     def start(self):
         pass
@@ -47,80 +163,421 @@ class Presence(ABC):
 
 
 
+KNOWN = 0x01
+ANSWERING = 0x02
+
+
+class PresenceTable:
+    """
+    Columnar state of the IpPresences. The last seen times and the state flags are kept in typed arrays,
+    indexed by the slot of the presence. Slots of released presences are reused.
+    The last seen time is kept twice: as UTC epoch seconds, which are persisted and exchanged with other
+    nodes, and on the monotonic clock, which is used for the state checks. So a clock step (e.g. the first
+    NTP sync of a host without RTC) does not change the presence state
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.last_seen = array('d')
+        self.last_seen_mono = array('d')
+        self.flags = array('B')
+        self.__free_slots: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.last_seen) - len(self.__free_slots)
+
+    def allocate(self, last_seen_ts: float, flags: int) -> int:
+        last_seen_mono = monotonic() - (time() - last_seen_ts)
+        with self.__lock:
+            if self.__free_slots:
+                slot = self.__free_slots.pop()
+                self.last_seen[slot] = last_seen_ts
+                self.last_seen_mono[slot] = last_seen_mono
+                self.flags[slot] = flags
+            else:
+                slot = len(self.last_seen)
+                self.last_seen.append(last_seen_ts)
+                self.last_seen_mono.append(last_seen_mono)
+                self.flags.append(flags)
+            return slot
+
+    def release(self, slot: int):
+        with self.__lock:
+            self.__free_slots.append(slot)
+
+
+_default_table = None
+_default_table_lock = Lock()
+
+
+def default_presence_table() -> PresenceTable:
+    global _default_table
+    with _default_table_lock:
+        if _default_table is None:
+            _default_table = PresenceTable()
+        return _default_table
+
+
 class IpPresence(Presence):
 
-    def __init__(self, name: str, addr: str, timeout_sec: int):
-        self.__is_running = True
-        self.addr = addr
-        self.__last_time_presence = datetime.now() - timedelta(days=365)
+    __slots__ = ("__engine", "__table", "__slot")
+
+    def __init__(self, name: str, addr: str, timeout_sec: int, engine: ProbeEngine = None, last_time_presence: datetime = None, table: PresenceTable = None):
+        self.__engine = default_probe_engine() if engine is None else engine
+        self.__table = default_presence_table() if table is None else table
+        if last_time_presence is None:
+            # never seen. The initial probe round gets the retries of an absent device
+            self.__slot = self.__table.allocate(time() - NEVER_SEC, 0)
+        else:
+            last_seen_ts = to_ts(last_time_presence)
+            self.__slot = self.__table.allocate(last_seen_ts, (ANSWERING | KNOWN) if time() - last_seen_ts < timeout_sec else KNOWN)
         super().__init__(name, addr, timeout_sec)
-        self.__check()
+
+    def __del__(self):
+        self.__table.release(self.__slot)
+
+    @property
+    def table(self) -> PresenceTable:
+        return self.__table
+
+    @property
+    def slot(self) -> int:
+        return self.__slot
 
     @property
     def last_time_presence(self) -> datetime:
-        return self.__last_time_presence
+        return from_ts(self.__table.last_seen[self.__slot])
 
-    def __check(self):
-        pings = self.ping()
-        if pings> 0:
-            self.__last_time_presence = datetime.utcnow()
-            #logging.debug(self.name + " present pings " + str(pings))
-        self._notify_listeners(self.name)
+    @property
+    def last_seen_ts(self) -> float:
+        return self.__table.last_seen[self.__slot]
+
+    @property
+    def last_seen_mono(self) -> float:
+        return self.__table.last_seen_mono[self.__slot]
 
-    def ping(self, count: int = 5) -> int:
-        successful_pings = 0
-        for i in range(count):
-            ping_packet = IP(dst=self.addr) / ICMP()
-            response = sr1(ping_packet, timeout=3, verbose=False)
-            if response:
-                successful_pings += 1
-        return successful_pings
+    @property
+    def is_known(self) -> bool:
+        return self.__table.flags[self.__slot] & KNOWN != 0
+
+    @property
+    def is_answering(self) -> bool:
+        return self.__table.flags[self.__slot] & ANSWERING != 0
+
+    def on_probe_result(self, rtt: Optional[float]):
+        if rtt is None:
+            self.__table.flags[self.__slot] = KNOWN
+        else:
+            self.__table.last_seen[self.__slot] = time()
+            self.__table.last_seen_mono[self.__slot] = monotonic()
+            self.__table.flags[self.__slot] = KNOWN | ANSWERING
+        self._notify_listeners(self.name)
 
     def start(self):
-        Thread(target=self.__check_loop, daemon=True).start()
+        self.__engine.register(self)
 
     def stop(self):
+        self.__engine.unregister(self)
+
+
+class PassiveSniffer:
+    """
+    Watches ARP, DHCP and mDNS frames with a single scapy AsyncSniffer and reports frames
+    sent by a registered SniffPresence (matched by MAC or IP address)
+    """
+
+    def __init__(self, iface: str = None):
+        # scapy is slow to import. Only the required layers are loaded, when the first sniffer is created
+        from scapy.sendrecv import AsyncSniffer
+        from scapy.layers.l2 import ARP, Ether
+        from scapy.layers.inet import IP
+        from scapy.layers.dhcp import BOOTP, DHCP
+        self.__async_sniffer = AsyncSniffer
+        self.__layers = (ARP, BOOTP, DHCP, Ether, IP)
+        self.__iface = iface
+        self.__lock = Lock()
+        self.__presences: Dict[str, List] = dict()   # lower-case MAC or IP address -> presences
+        self.__sniffer = None
+        self.__sniffed_addrs = frozenset()
         self.__is_running = False
 
-    def __check_loop(self):
+    def register(self, presence):
+        # the sniffer is (re)started by the maintenance loop, so that registering many presences restarts it once only
+        with self.__lock:
+            self.__presences.setdefault(presence.addr.lower(), []).append(presence)
+            if not self.__is_running:
+                self.__is_running = True
+                Thread(target=self.__maintenance_loop, daemon=True).start()
+
+    def unregister(self, presence):
+        with self.__lock:
+            presences = self.__presences.get(presence.addr.lower(), [])
+            if presence in presences:
+                presences.remove(presence)
+            if not presences:
+                self.__presences.pop(presence.addr.lower(), None)
+
+    @staticmethod
+    def __bpf_filter(addrs) -> str:
+        # DHCP requests are sent from 0.0.0.0 before the device has an address. They are matched by
+        # the client MAC or the requested address in __on_packet instead of the kernel filter
+        sources = [("ether src " + addr) if MAC_ADDR.match(addr) else ("host " + addr) for addr in sorted(addrs)]
+        return "(udp and (port 67 or port 68)) or ((arp or (udp and port 5353)) and (" + " or ".join(sources) + "))"
+
+    def __restart_if_changed(self):
+        with self.__lock:
+            addrs = frozenset(self.__presences.keys())
+        if addrs == self.__sniffed_addrs:
+            return
+        if self.__sniffer is not None:
+            self.__sniffer.stop()
+            self.__sniffer = None
+        if addrs:
+            self.__sniffer = self.__async_sniffer(iface=self.__iface, filter=self.__bpf_filter(addrs), prn=self.__on_packet, store=False)
+            self.__sniffer.start()
+        self.__sniffed_addrs = addrs
+
+    def __on_packet(self, packet):
+        ARP, BOOTP, DHCP, Ether, IP = self.__layers
+        addrs = set()
+        if DHCP in packet:
+            # only requests of the clients. Replies of the DHCP server carry the client addresses as well
+            if packet[BOOTP].op == 1:
+                addrs.add(':'.join('%02x' % byte for byte in packet[BOOTP].chaddr[:6]))
+                addrs.update(str(option[1]) for option in packet[DHCP].options if isinstance(option, tuple) and option[0] == 'requested_addr')
+                if packet[BOOTP].ciaddr != "0.0.0.0":
+                    addrs.add(packet[BOOTP].ciaddr)
+        else:
+            if Ether in packet:
+                addrs.add(packet[Ether].src.lower())
+            if ARP in packet:
+                addrs.add(packet[ARP].hwsrc.lower())
+                addrs.add(packet[ARP].psrc)
+            if IP in packet:
+                addrs.add(packet[IP].src)
+        for addr in addrs:
+            for presence in list(self.__presences.get(addr, [])):
+                presence.on_seen()
+
+    def __maintenance_loop(self):
+        # no probe results drive the passive presences. Re-evaluate them periodically to detect absence
         while self.__is_running:
+            sleep(5)
             try:
-                self.__check()
-                if (datetime.now() - self.__last_time_presence).total_seconds() > 60:
-                    sleep(5)
-                else:
-                    sleep(20)
+                self.__restart_if_changed()
+                with self.__lock:
+                    presences = [presence for presences in self.__presences.values() for presence in presences]
+                [presence.on_tick() for presence in presences]
             except Exception as e:
                 logging.warning(e, exc_info=True)
-                sleep(3)
+
+
+_default_sniffer = None
+_default_sniffer_lock = Lock()
+
+
+def default_sniffer() -> PassiveSniffer:
+    global _default_sniffer
+    with _default_sniffer_lock:
+        if _default_sniffer is None:
+            _default_sniffer = PassiveSniffer()
+        return _default_sniffer
+
+
+class SniffPresence(Presence):
+
+    def __init__(self, name: str, addr: str, timeout_sec: int, sniffer: PassiveSniffer = None, last_time_presence: datetime = None):
+        self.__sniffer = default_sniffer() if sniffer is None else sniffer
+        self.__last_time_presence = datetime.utcnow() - timedelta(days=365) if last_time_presence is None else last_time_presence
+        self.__last_seen_mono = monotonic() - (datetime.utcnow() - self.__last_time_presence).total_seconds()
+        self.__is_known = last_time_presence is not None
+        self.__start_time = monotonic()
+        super().__init__(name, addr, timeout_sec)
+
+    @property
+    def last_time_presence(self) -> datetime:
+        return self.__last_time_presence
+
+    @property
+    def last_seen_mono(self) -> float:
+        return self.__last_seen_mono
+
+    @property
+    def is_known(self) -> bool:
+        # without any frame within the timeout the device is considered as absent
+        if not self.__is_known:
+            self.__is_known = monotonic() - self.__start_time > self.timeout_sec
+        return self.__is_known
+
+    def on_seen(self):
+        was_presence = self.is_presence and self.is_known
+        self.__is_known = True
+        self.__last_time_presence = datetime.utcnow()
+        self.__last_seen_mono = monotonic()
+        if not was_presence:
+            self._notify_listeners(self.name)
+
+    def on_tick(self):
+        self._notify_listeners(self.name)
+
+    def start(self):
+        self.__sniffer.register(self)
+
+    def stop(self):
+        self.__sniffer.unregister(self)
 
 
 class Presences(Presence):
+    """
+    Group of presences. In 'any' mode the group is present if any member is present, in 'all' mode
+    if all members are present. The aggregated last seen time (the latest or the earliest of the
+    known members) is maintained incrementally on member notifications. A rescan of the members is only
+    required if the member holding the aggregate changes in the opposite direction
+    """
 
-    def __init__(self, name: str, presences: List[Presence], timeout_sec: int):
-        self.__is_running = True
-        self.__presences = presences
-        [presence.add_listener(self.__notify) for presence in presences]
+    def __init__(self, name: str, presences: List[Presence], timeout_sec: int, mode: str = "any"):
+        if mode not in ("any", "all"):
+            raise ValueError("unsupported group mode " + mode)
+        self.__is_any = mode == "any"
+        self.__lock = Lock()
+        self.__never = monotonic() - NEVER_SEC
+        self.__heartbeat = DebouncedListener(self.__notify_all, 1)
+        self.__presences: List[Presence] = []
+        self.__members: Dict[str, Presence] = dict()
+        self.__last_seen: Dict[str, float] = dict()     # monotonic clock, of the known members only
+        self.__unknown = set()
+        self.__aggregate_name, self.__aggregate = None, self.__never
+        # the initial state is aggregated before initializing the presence, which takes it as already reported
+        self.__aggregate_members(presences)
         super().__init__(name, "", timeout_sec)
-        Thread(target=self.__report_loop, daemon=True).start()
+        self.set_members(presences)
+        _register_group(self)
+
+    @property
+    def mode(self) -> str:
+        return "any" if self.__is_any else "all"
+
+    @property
+    def members(self) -> List[Presence]:
+        return list(self.__presences)
+
+    def set_members(self, presences: List[Presence]):
+        with self.__lock:
+            for presence in self.__presences:
+                if presence not in presences:
+                    presence.remove_listener(self.__notify)
+                    presence.remove_listener(self.__heartbeat, heartbeat=True)
+            for presence in presences:
+                if presence not in self.__presences:
+                    presence.add_listener(self.__notify)
+                    presence.add_listener(self.__heartbeat, heartbeat=True)
+            self.__presences = list(presences)
+            self.__aggregate_members(presences)
+        self._notify_listeners(self.name)
+
+    def __aggregate_members(self, presences: List[Presence]):
+        self.__members = {presence.name: presence for presence in presences}
+        self.__last_seen = {presence.name: presence.last_seen_mono for presence in presences if presence.is_known}
+        self.__unknown = {presence.name for presence in presences if not presence.is_known}
+        self.__aggregate_name, self.__aggregate = self.__scan()
 
     @property
     def last_time_presence(self) -> datetime:
-        last_date_presence = datetime.now() - timedelta(days=365)
-        for presence in self.__presences:
-            if presence.last_time_presence > last_date_presence:
-                last_date_presence = presence.last_time_presence
-        return last_date_presence
+        return from_ts(self.last_seen_ts)
+
+    @property
+    def last_seen_ts(self) -> float:
+        return time() - (monotonic() - self.__aggregate)
+
+    @property
+    def last_seen_mono(self) -> float:
+        return self.__aggregate
+
+    @property
+    def is_known(self) -> bool:
+        if self.__is_any:
+            return not self.__unknown or self.is_presence
+        else:
+            # an absent member makes the group absent, no matter if other members are unknown
+            return not self.__unknown or (self.__aggregate_name is not None and not self.is_presence)
+
+    def __scan(self):
+        if not self.__last_seen:
+            return None, self.__never
+        name = (max if self.__is_any else min)(self.__last_seen, key=self.__last_seen.get)
+        return name, self.__last_seen[name]
+
+    def __update(self, presence: Presence):
+        with self.__lock:
+            if not presence.is_known:
+                # unknown members are not aggregated. E.g. the last seen time of a never seen member is no absence
+                self.__unknown.add(presence.name)
+                self.__last_seen.pop(presence.name, None)
+                if presence.name == self.__aggregate_name:
+                    self.__aggregate_name, self.__aggregate = self.__scan()
+                return
+            self.__unknown.discard(presence.name)
+            last_seen = presence.last_seen_mono
+            self.__last_seen[presence.name] = last_seen
+            if self.__is_any:
+                if last_seen >= self.__aggregate:
+                    self.__aggregate_name, self.__aggregate = presence.name, last_seen
+                elif presence.name == self.__aggregate_name:
+                    self.__aggregate_name, self.__aggregate = self.__scan()
+            else:
+                if self.__aggregate_name is None or last_seen <= self.__aggregate:
+                    self.__aggregate_name, self.__aggregate = presence.name, last_seen
+                elif presence.name == self.__aggregate_name:
+                    self.__aggregate_name, self.__aggregate = self.__scan()
 
     def __notify(self, name: str):
-        self._notify_listeners(self.name)
+        member = self.__members.get(name, None)
+        if member is not None:
+            self.__update(member)
+            self._notify_listeners(self.name)
 
-    def __report_loop(self):
-        while self.__is_running:
+    def __notify_all(self, names: Set[str]):
+        # the heartbeats of the members are recomputed once per debounce period
+        members = [self.__members[name] for name in names if name in self.__members]
+        if members:
+            [self.__update(member) for member in members]
+            self._notify_listeners(self.name)
+
+    def stop(self):
+        with _groups_lock:
+            _groups.discard(self)
+        self.set_members([])
+
+    def report(self):
+        for presences in self.__presences:
+            if presences.is_known:
+                logging.info((presences.name + " is presence") if presences.is_presence else (presences.name + " is absent"))
+            else:
+                logging.info(presences.name + " is unknown")
+
+
+_groups: "WeakSet[Presences]" = WeakSet()
+_groups_lock = Lock()
+_is_reporting = False
+
+
+def _register_group(group: Presences):
+    # the member states of all groups are reported by a single thread
+    global _is_reporting
+    with _groups_lock:
+        _groups.add(group)
+        if not _is_reporting:
+            _is_reporting = True
+            Thread(target=_report_loop, daemon=True).start()
+
+
+def _report_loop():
+    while True:
+        with _groups_lock:
+            groups = list(_groups)
+        for group in groups:
             try:
-                for presences in self.__presences:
-                    logging.info((presences.name + " is presence") if presences.is_presence else (presences.name + " is absent"))
+                group.report()
             except Exception as e:
                 logging.warning("error occurred on reporting " + str(e))
-            sleep(60*60)
-
+        sleep(60*60)
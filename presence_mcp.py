@@ -1,17 +1,25 @@
+import json
 import asyncio
 import logging
 import threading
-from typing import Protocol, cast, List, Dict
+from typing import Protocol, cast, Dict, Optional, List, Any, Tuple, Union
 from fastmcp import FastMCP
 from pydantic import AnyUrl, TypeAdapter
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from zeroconf import IPVersion, ServiceInfo, Zeroconf
 import socket
-from presence import Presence
+from registry import PresenceRegistry, PresenceState
+from history import PresenceHistory
+from presence import to_ts
+from metrics import REGISTRY, Gauge
 
 
 logger = logging.getLogger(__name__)
 
+STATUS = {"present": "PRESENT", "absent": "AWAY", "unknown": "UNKNOWN"}
+NOTIFICATION_COALESCING_SEC = 0.1
+RESOURCE_LIST_CHANGED = "resource list changed"     # queued by the SessionSender like a URI
+
 
 
 def _get_duration_str(last_change: datetime) -> str:
@@ -66,6 +74,9 @@ class MDNS:
         try:
             s.connect(("8.8.8.8", 80))
             self.local_ip = s.getsockname()[0]
+        except OSError:
+            # no route (offline host)
+            self.local_ip = "127.0.0.1"
         finally:
             s.close()
 
@@ -105,10 +116,55 @@ class ResourceUpdateSession(Protocol):
     async def send_resource_updated(self, uri: AnyUrl) -> None:
         ...
 
+    async def send_resource_list_changed(self) -> None:
+        ...
+
+
+
+class SessionSender:
+    """
+    Delivers the resource updates of a single session by its own task, so that a slow or dead
+    client does not delay the updates of the others. An update of a URI that is already pending
+    is coalesced with it, so the pending updates are bounded by the number of resources.
+    """
+
+    def __init__(self, session: ResourceUpdateSession, on_dead, timeout_sec: float = 5):
+        self.session = session
+        self.__on_dead = on_dead
+        self.__timeout_sec = timeout_sec
+        self.__pending: Dict[Any, None] = dict()       # ordered set of the URIs to send
+        self.__has_pending = asyncio.Event()
+        self.__task = asyncio.get_running_loop().create_task(self.__send_loop())
+
+    def offer(self, uri):
+        self.__pending[uri] = None
+        self.__has_pending.set()
+
+    async def __send_loop(self):
+        while True:
+            await self.__has_pending.wait()
+            self.__has_pending.clear()
+            while self.__pending:
+                uri = next(iter(self.__pending))
+                del self.__pending[uri]
+                try:
+                    if uri is RESOURCE_LIST_CHANGED:
+                        await asyncio.wait_for(self.session.send_resource_list_changed(), self.__timeout_sec)
+                    else:
+                        await asyncio.wait_for(self.session.send_resource_updated(uri), self.__timeout_sec)
+                    logger.debug("[Server] update %s sent to client", uri)
+                except Exception as e:
+                    logger.warning("[Server] client not reachable: %s", e)
+                    self.__on_dead(self)
+                    return
+
+    def close(self):
+        self.__task.cancel()
+
 
 
 class PresenceMCPServer:
-    def __init__(self, name: str, port: int, presences: List[Presence], host: str = "0.0.0.0"):
+    def __init__(self, name: str, port: int, registry: PresenceRegistry, history: Optional[PresenceHistory] = None, host: str = "0.0.0.0", loop: Optional[asyncio.AbstractEventLoop] = None):
         self.name = name
         self.host = host
         self.port = port
@@ -116,11 +172,26 @@ class PresenceMCPServer:
         self.mdns = MDNS()
         self.mcp = FastMCP(self.name)
         self.active_sessions: set[ResourceUpdateSession] = set()
+        self.json_sessions: set[ResourceUpdateSession] = set()      # sessions which have read JSON resources
+        REGISTRY.register(Gauge("presence_mcp_sessions", "MCP sessions registered for resource updates", lambda: len(self.active_sessions)))
         self.low_level_server = self.mcp._mcp_server
-        self.presences = presences
-        self.loop = asyncio.new_event_loop()
-        self.last_state: Dict[str, bool] = dict()
-        [presence.add_listener(self.__on_value_changed) for presence in self.presences]
+        self.registry = registry
+        self.history = history
+        # a shared loop (unified runtime) is run by its owner. Otherwise the server runs its own loop by a dedicated thread
+        self.__is_shared_loop = loop is not None
+        self.loop = asyncio.new_event_loop() if loop is None else loop
+        self.__loop_thread: Optional[int] = None
+        self.__task: Optional[asyncio.Task] = None
+        self.last_state: Dict[str, str] = dict()
+        self.__uri_adapter = TypeAdapter(AnyUrl)
+        self.__uris: Dict[Tuple[str, bool], AnyUrl] = dict()
+        [self.__uri(name) for name in self.registry.snapshot.names]
+        self.__dicts: Dict[str, Tuple[PresenceState, Dict[str, Any]]] = dict()
+        self.__senders: Dict[ResourceUpdateSession, SessionSender] = dict()
+        self.__pending_names: set[str] = set()
+        self.__names = self.registry.snapshot.names
+        self.__flush_handle: Optional[asyncio.TimerHandle] = None
+        self.registry.add_listener(self.__on_value_changed)
 
 
         @self.mcp.resource("sensor://presence")
@@ -131,9 +202,11 @@ class PresenceMCPServer:
             This resource helps the client discover which entities (e.g., specific
             entities or the 'any' aggregate) are currently tracked by the server.
             The returned names can then be used to query the detailed status
-            via the 'sensor://presence/{name}' resource.
+            via the 'sensor://presence/{name}' resource (or its JSON variant
+            'sensor://presence/{name}/json'), or many at once via the
+            'presence_query' tool.
             """
-            names = [p.name for p in self.presences]
+            names = self.registry.snapshot.names
             if not names:
                 return "No sensors available."
             return "Available sensors: " + ", ".join(names)
@@ -144,7 +217,8 @@ class PresenceMCPServer:
             """
             Retrieves the detailed presence status for a specific entity by its name.
 
-            This resource provides the current state (PRESENT or AWAY)
+            This resource provides the current state (PRESENT, AWAY or UNKNOWN
+            as long as the state has not been determined after a server start).
             Crucially, accessing this resource automatically registers the client's
             session to receive real-time push notifications whenever this specific
             sensor's state changes in the future.
@@ -158,24 +232,89 @@ class PresenceMCPServer:
             """
 
             # 1. Session registration
-            try:
-                req_ctx = self.low_level_server.request_context
-                if req_ctx and req_ctx.session and req_ctx.session not in self.active_sessions:
-                    self.active_sessions.add(cast(ResourceUpdateSession, req_ctx.session))
-                    logger.info(f"[Server] Client session registered for updates (Resource: {name}).")
-            except Exception as e:
-                # FIX 2: Log the exception instead of silently ignoring it
-                logger.debug(f"[Server] Could not register session: {e}")
+            self.__register_session(name)
 
             # 2. Search and format presence
-            for p in self.presences:
-                if p.name == name:
-                    status = "PRESENT" if p.is_presence else "AWAY"
-                    return f"- {p.name}: {status}"
+            p = self.registry.snapshot.by_name.get(name, None)
+            if p is not None:
+                status = STATUS[p.status]
+                return f"- {p.name}: {status}"
 
             return f"Error: Sensor for '{name}' not found."
 
 
+        @self.mcp.resource("sensor://presence/{name}/json", mime_type="application/json")
+        def get_presence_json(name: str) -> str:
+            """
+            Retrieves the presence status of a specific entity by its name as JSON object.
+
+            The object contains the fields 'name', 'status' ('present', 'absent' or 'unknown'),
+            'last_seen' (ISO8601 UTC timestamp) and 'age_sec' (seconds since last seen).
+            Like 'sensor://presence/{name}', accessing this resource registers the client's
+            session to receive push notifications whenever the sensor's state changes.
+
+            Args:
+                name: The exact name of the sensor/entity (e.g., 'Alice' or 'any').
+
+            Returns:
+                The JSON object, or a JSON object with an 'error' field if the requested
+                sensor name is not found.
+            """
+            self.__register_session(name, is_json=True)
+            state = self.registry.snapshot.by_name.get(name, None)
+            if state is None:
+                return json.dumps({"error": f"Sensor for '{name}' not found."})
+            return json.dumps(self.__as_dict(state))
+
+
+        @self.mcp.tool(name="presence_query")
+        def query_presences(names: Optional[List[str]] = None, status: Optional[List[str]] = None, seen_since: Optional[str] = None) -> Union[Dict[str, Any], str]:
+            """
+            Queries the state of many presence entities at once and returns structured data.
+
+            Prefer this tool over reading 'sensor://presence/{name}' for each entity if the
+            state of several entities is needed. All filters are optional and combined.
+
+            Args:
+                names: The exact names of the entities to return (default: all entities).
+                status: Only return entities with one of these states: 'present', 'absent'
+                        or 'unknown' (default: all states).
+                seen_since: Only return entities seen at or after this ISO8601 timestamp,
+                            e.g. '2024-05-01T08:00:00Z' (naive timestamps are taken as UTC).
+
+            Returns:
+                dict: 'presences' lists one object per matching entity with the fields 'name',
+                      'status', 'last_seen' (ISO8601 UTC) and 'age_sec'. 'not_found' lists the
+                      requested names which are unknown to the server. If a filter is invalid,
+                      a string describing the error is returned instead.
+            """
+            invalid = [value for value in (status or []) if value not in STATUS]
+            if invalid:
+                return f"Error: Unsupported status {', '.join(invalid)}. Use 'present', 'absent' or 'unknown'."
+            since_ts = None
+            if seen_since:
+                try:
+                    since = datetime.fromisoformat(seen_since)
+                except ValueError as e:
+                    return f"Error: Invalid seen_since timestamp '{seen_since}': {e}"
+                if since.tzinfo is not None:
+                    since = since.astimezone(timezone.utc).replace(tzinfo=None)
+                since_ts = to_ts(since)
+
+            snapshot = self.registry.snapshot
+            if names is None:
+                states = snapshot.states
+                not_found = []
+            else:
+                states = [snapshot.by_name[name] for name in names if name in snapshot.by_name]
+                not_found = [name for name in names if name not in snapshot.by_name]
+            if status:
+                states = [state for state in states if state.status in status]
+            if since_ts is not None:
+                states = [state for state in states if state.last_seen_ts >= since_ts]
+            return {"presences": [self.__as_dict(state) for state in states], "not_found": not_found}
+
+
         @self.mcp.tool(name="presence_overview")
         def get_presence_overview() -> str:
             """
@@ -188,27 +327,28 @@ class PresenceMCPServer:
 
             Returns:
                 str: A formatted, multi-line string report. Each line details an entity's
-                     name, current status (PRESENT or AWAY), the relative time elapsed since
+                     name, current status (PRESENT, AWAY or UNKNOWN), the relative time elapsed since
                      their last state change, and the exact UTC timestamp. If an internal
                      error occurs, a string describing the error is returned instead.
             """
             try:
-                if not self.presences:
+                states = self.registry.snapshot.states
+                if not states:
                     return "No presence entities are currently being tracked."
 
                 lines = []
                 # Sort by presence: PRESENT entities appear first in the list
-                sorted_presences = sorted(self.presences, key=lambda x: x.is_presence, reverse=True)
+                sorted_presences = sorted(states, key=lambda x: x.is_presence, reverse=True)
 
                 for p in sorted_presences:
-                    status = "PRESENT" if p.is_presence else "AWAY"
+                    status = STATUS[p.status]
 
                     # Get relative duration string (e.g., '2h 15m')
-                    duration = _get_duration_str(p.last_time_presence)
+                    duration = _get_duration_str(p.last_seen)
 
                     # Format timestamp; ensure we use UTC consistently
-                    if p.last_time_presence:
-                        ts_aware = p.last_time_presence if p.last_time_presence.tzinfo else p.last_time_presence.replace(tzinfo=timezone.utc)
+                    if p.last_seen:
+                        ts_aware = p.last_seen if p.last_seen.tzinfo else p.last_seen.replace(tzinfo=timezone.utc)
                         timestamp = ts_aware.strftime("%Y-%m-%d %H:%M")
                     else:
                         timestamp = "Never"
@@ -224,39 +364,137 @@ class PresenceMCPServer:
                 return f"Error generating presence overview: {e}"
 
 
+        @self.mcp.tool(name="presence_history")
+        def get_presence_history(name: str, days: int = 7) -> str:
+            """
+            Answers when a specific entity was last seen (e.g. "when was Alice last home?") and lists
+            its arrivals and departures within the given number of past days.
 
-    def __on_value_changed(self, name: str):
-        asyncio.run_coroutine_threadsafe(self._trigger_client_notification(name), self.loop)
+            The history is persisted, so it covers the time before the last server restart as well.
+
+            Args:
+                name: The exact name of the sensor/entity (e.g., 'Alice' or 'any').
+                days: The number of past days to list the arrivals and departures for (default 7).
 
+            Returns:
+                str: A formatted, multi-line string report with the last seen UTC timestamp followed
+                     by one line per transition (oldest first), or an error message if no history is
+                     available for the entity.
+            """
+            if self.history is None:
+                return "Error: No presence history is recorded."
+            try:
+                last_seen = self.history.last_seen(name)
+                if last_seen is None:
+                    return f"Error: No history for '{name}' found."
+                lines = [f"{name} was last seen: {last_seen.strftime('%Y-%m-%d %H:%M')} UTC ({_get_duration_str(last_seen)} ago)"]
+                for time, is_presence in self.history.transitions(name, datetime.utcnow() - timedelta(days=days)):
+                    lines.append(f"- {time.strftime('%Y-%m-%d %H:%M')} UTC: {'arrived' if is_presence else 'left'}")
+                return "\n".join(lines)
+            except Exception as e:
+                logging.warning(f"Failed to generate presence history: {e}", exc_info=True)
+                return f"Error generating presence history: {e}"
 
-    async def _trigger_client_notification(self, name: str) -> None:
+
+
+    def __on_value_changed(self, name: str):
+        if threading.get_ident() == self.__loop_thread:
+            self._trigger_client_notification(name)
+        else:
+            self.loop.call_soon_threadsafe(self._trigger_client_notification, name)
+
+
+    def _trigger_client_notification(self, name: str) -> None:
+        # must be called within the loop. Updates received within the coalescing window are sent together, each URI at most once
+        if name not in self.registry.snapshot.by_name:
+            # removed (e.g. by reloading the device configuration)
+            self.__dicts.pop(name, None)
+            self.__uris.pop((name, False), None)
+            self.__uris.pop((name, True), None)
+            self.last_state.pop(name, None)
         if not self.active_sessions:
             return
+        self.__pending_names.add(name)
+        if self.__flush_handle is None:
+            self.__flush_handle = self.loop.call_later(NOTIFICATION_COALESCING_SEC, self.__flush_notifications)
 
-        for presence in self.presences:
-            if presence.name == name:
-                last_state = self.last_state.get(name, None)
-                if presence.is_presence != last_state:
-                    self.last_state[name] = presence.is_presence
-                    dead_sessions = set()
-                    for session in self.active_sessions:
-                        try:
-                            logger.info("[Server] Sende Update an Client...")
-                            await session.send_resource_updated(TypeAdapter(AnyUrl).validate_python("sensor://presence/" + name))
-                        except Exception as e:
-                            logger.warning("[Server] Client nicht mehr erreichbar: %s", e)
-                            dead_sessions.add(session)
-
-                    self.active_sessions.difference_update(dead_sessions)
-                break
+    def __register_session(self, name: str, is_json: bool = False):
+        try:
+            req_ctx = self.low_level_server.request_context
+            if req_ctx and req_ctx.session:
+                if req_ctx.session not in self.active_sessions:
+                    self.active_sessions.add(cast(ResourceUpdateSession, req_ctx.session))
+                    logger.info(f"[Server] Client session registered for updates (Resource: {name}).")
+                if is_json:
+                    self.json_sessions.add(cast(ResourceUpdateSession, req_ctx.session))
+        except Exception as e:
+            # FIX 2: Log the exception instead of silently ignoring it
+            logger.debug(f"[Server] Could not register session: {e}")
+
+    def __as_dict(self, state: PresenceState) -> Dict[str, Any]:
+        # the static part is computed once per state
+        cached = self.__dicts.get(state.name, None)
+        if cached is None or cached[0] is not state:
+            cached = (state, {"name": state.name, "status": state.status, "last_seen": state.last_seen.strftime("%Y-%m-%dT%H:%M:%SZ")})
+            self.__dicts[state.name] = cached
+        return dict(cached[1], age_sec=state.age_sec)
+
+    def __uri(self, name: str, is_json: bool = False) -> AnyUrl:
+        key = (name, is_json)
+        uri = self.__uris.get(key, None)
+        if uri is None:
+            uri = self.__uri_adapter.validate_python("sensor://presence/" + name + ("/json" if is_json else ""))
+            self.__uris[key] = uri
+        return uri
+
+    def __flush_notifications(self):
+        self.__flush_handle = None
+        names, self.__pending_names = self.__pending_names, set()
+        snapshot = self.registry.snapshot
+        is_list_changed = snapshot.names is not self.__names
+        self.__names = snapshot.names
+        changed_names = []
+        for name in names:
+            presence = snapshot.by_name.get(name, None)
+            if presence is None:
+                self.last_state.pop(name, None)
+            elif presence.status != self.last_state.get(name, None):
+                self.last_state[name] = presence.status
+                changed_names.append(name)
+        if changed_names or is_list_changed:
+            for session in list(self.active_sessions):
+                sender = self.__senders.get(session, None)
+                if sender is None:
+                    sender = SessionSender(session, self.__on_dead_session)
+                    self.__senders[session] = sender
+                if is_list_changed:
+                    sender.offer(RESOURCE_LIST_CHANGED)
+                [sender.offer(self.__uri(name)) for name in changed_names]
+                if session in self.json_sessions:
+                    [sender.offer(self.__uri(name, is_json=True)) for name in changed_names]
+
+    def __on_dead_session(self, sender: SessionSender):
+        self.active_sessions.discard(sender.session)
+        self.json_sessions.discard(sender.session)
+        self.__senders.pop(sender.session, None)
+        sender.close()
+
+    def __close_senders(self):
+        # must be called within the loop
+        [sender.close() for sender in self.__senders.values()]
+        self.__senders.clear()
 
     async def __run(self) -> None:
+        self.__loop_thread = threading.get_ident()
         logger.info(f"MCP Server '{self.name}' running on http://{self.host}:{self.port}/sse")
         await self.mcp.run_async(transport="sse", host=self.host, port=self.port)
 
 
     def start(self):
         self.mdns.register_mdns(self.name, self.port)
+        if self.__is_shared_loop:
+            self.loop.call_soon_threadsafe(self.__start_task)
+            return
 
         def _run_loop():
             asyncio.set_event_loop(self.loop)
@@ -269,7 +507,17 @@ class PresenceMCPServer:
         thread.start()
 
 
+    def __start_task(self):
+        self.__task = self.loop.create_task(self.__run())
+
     def stop(self):
         self.mdns.unregister_mdns(self.name)
-        self.loop.stop()
-        logging.info("MCP Server stopped")
\ No newline at end of file
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.__close_senders)
+            if self.__is_shared_loop:
+                if self.__task is not None:
+                    self.loop.call_soon_threadsafe(self.__task.cancel)
+            else:
+                # stopped one iteration later, so that the cancelled senders are finished
+                self.loop.call_soon_threadsafe(self.loop.call_soon, self.loop.stop)
+        logging.info("MCP Server stopped")
@@ -0,0 +1,149 @@
+import tornado.ioloop
+from threading import Lock
+from typing import Callable, Dict, List
+from webthing import Property, Thing, Value
+from redzoo.math.display import duration
+from presence import Presence
+from registry import PresenceRegistry, PresenceState
+
+
+class PresenceThing(Thing):
+
+    # regarding capabilities refer https://iot.mozilla.org/schemas
+    # there is also another schema registry http://iotschema.org/docs/full.html not used by webthing
+
+    def __init__(self, description: str, presence: Presence, registry: PresenceRegistry):
+        Thing.__init__(
+            self,
+            'urn:dev:ops:presence-1',
+            'presence_' + presence.name,
+            ['MultiLevelSensor'],
+            description
+        )
+        self.presence = presence
+        state = registry.snapshot.by_name[presence.name]
+        self.__published_state = state
+
+        self.name = Value(presence.name)
+        self.add_property(
+            Property(self,
+                     'name',
+                     self.name,
+                     metadata={
+                         'title': 'name',
+                         "type": "string",
+                         'description': 'the device name',
+                         'readOnly': True,
+                     }))
+
+        self.addr = Value(presence.addr)
+        self.add_property(
+            Property(self,
+                     'addr',
+                     self.addr,
+                     metadata={
+                         'title': 'addr',
+                         "type": "string",
+                         'description': 'the device address',
+                         'readOnly': True,
+                     }))
+
+        self.is_presence = Value(state.is_presence if state.is_known else None)
+        self.add_property(
+            Property(self,
+                     'is_presence',
+                     self.is_presence,
+                     metadata={
+                         'title': 'is_presence',
+                         "type": "boolean",
+                         'description': 'true, if presence (null, if not determined yet)',
+                         'readOnly': True,
+                     }))
+
+        self.last_time_presence = Value(state.last_seen_str)
+        self.add_property(
+            Property(self,
+                     'last_time_presence_utc',
+                     self.last_time_presence,
+                     metadata={
+                         'title': 'last_time_presence_utc',
+                         "type": "string",
+                         'description': 'the last time presence ISO8601 string (UTC)',
+                         'readOnly': True,
+                     }))
+
+        self.elapsed_since_last_seen = Value(duration(state.age_sec, 1))
+        self.add_property(
+            Property(self,
+                     'elapsed_since_last_seen',
+                     self.elapsed_since_last_seen,
+                     metadata={
+                         'title': 'elapsed_since_last_seen',
+                         "type": "string",
+                         'description': 'elapsed time since last seen',
+                         'readOnly': True,
+                     }))
+
+    def publish(self, state: PresenceState):
+        # must be called within the ioloop thread
+        if state is self.__published_state:
+            return
+        previous, self.__published_state = self.__published_state, state
+        if state.last_seen_str != previous.last_seen_str:
+            self.last_time_presence.notify_of_external_update(state.last_seen_str)
+            self.refresh_elapsed()
+        if state.status != previous.status:
+            self.is_presence.notify_of_external_update(state.is_presence if state.is_known else None)
+
+    def refresh_elapsed(self):
+        # must be called within the ioloop thread
+        self.elapsed_since_last_seen.notify_of_external_update(duration(self.__published_state.age_sec, 1))
+
+
+class ThingPublisher:
+    """
+    Publishes the snapshot changes to the things. Changes are collected and applied by a single
+    ioloop callback per tick. The elapsed time, which changes without any state change, is
+    refreshed for all things by a coarse timer
+    """
+
+    def __init__(self, registry: PresenceRegistry, things: List[PresenceThing], elapsed_refresh_sec: int = 60):
+        self.ioloop = tornado.ioloop.IOLoop.current()
+        self.registry = registry
+        self.things: Dict[str, PresenceThing] = {thing.presence.name: thing for thing in things}
+        self.__things = things     # the list served by the webthing server
+        self.__lock = Lock()
+        self.__changed_names = set()
+        self.registry.add_listener(self.__on_value_changed)
+        tornado.ioloop.PeriodicCallback(self.__refresh_elapsed, elapsed_refresh_sec * 1000).start()
+
+    def __on_value_changed(self, name: str):
+        with self.__lock:
+            is_scheduled = len(self.__changed_names) > 0
+            self.__changed_names.add(name)
+        if not is_scheduled:
+            self.ioloop.add_callback(self.__publish)
+
+    def __publish(self):
+        with self.__lock:
+            names, self.__changed_names = self.__changed_names, set()
+        snapshot = self.registry.snapshot
+        for name in names:
+            thing = self.things.get(name, None)
+            state = snapshot.by_name.get(name, None)
+            if thing is not None and state is not None:
+                thing.publish(state)
+
+    def update(self, create_thing: Callable[[Presence], PresenceThing]):
+        # must be called within the ioloop thread. Syncs the things with the presences of the registry
+        things = []
+        for presence in self.registry.presences:
+            thing = self.things.get(presence.name, None)
+            things.append(thing if thing is not None and thing.presence is presence else create_thing(presence))
+        self.things = {thing.presence.name: thing for thing in things}
+        self.__things[:] = things
+        for idx, thing in enumerate(things):
+            thing.set_href_prefix('/' + str(idx))
+
+    def __refresh_elapsed(self):
+        [thing.refresh_elapsed() for thing in self.things.values()]
@@ -1,51 +1,250 @@
 import json
+import math
+import asyncio
+import hashlib
 import threading
 import logging
 from urllib.parse import urlparse, parse_qs
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from presence import Presence
-from typing import List, Dict, Any
+from http import HTTPStatus
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from time import monotonic
+from registry import PresenceRegistry, PresenceSnapshot, PresenceState
+from metrics import REGISTRY, Histogram
+from typing import Dict, List, Tuple, Optional
+
+
+MAX_WAIT_SEC = 60
+HTTP_REQUEST = REGISTRY.register(Histogram("presence_http_request_seconds", "latency of the HTTP requests (without event streams)", ("endpoint",)))
+IS_PRESENCE = {"present": "true", "absent": "false", "unknown": "unknown"}
+
+
+def parse_wait_sec(query: Dict[str, List[str]]) -> float:
+    """
+    returns the wait time of a long poll, limited to MAX_WAIT_SEC. Raises a ValueError, if it is not a number
+    """
+    wait_sec = float(query.get("wait", ["0"])[0])
+    if math.isnan(wait_sec):
+        raise ValueError("wait is not a number")
+    return max(0.0, min(wait_sec, MAX_WAIT_SEC))
+
+
+class Page:
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+
+class PresencePages:
+    """
+    Caches the rendered responses. The index page is re-rendered only if the device set changes,
+    the JSON body of a presence only if its state changes
+    """
+
+    def __init__(self, registry: PresenceRegistry):
+        self.__registry = registry
+        self.__index = (None, Page(b""))
+        self.__all = (None, Page(b""))
+        self.__json: Dict[str, Tuple[PresenceState, Page]] = dict()
+        self.__json_names = registry.snapshot.names
+
+    @staticmethod
+    def __as_dict(state: PresenceState) -> Dict[str, str]:
+        return {'is_presence': IS_PRESENCE[state.status], 'last_seen': state.last_seen_str}
+
+    def index(self) -> Page:
+        names, page = self.__index
+        snapshot = self.__registry.snapshot
+        if names is not snapshot.names:
+            page = Page(("<h1>available presences</h1><ul>" + "".join(f"<li><a href='/{name}'>{name}</a></li>" for name in snapshot.names) + "</ul>").encode("utf-8"))
+            self.__index = (snapshot.names, page)
+        return page
+
+    def all(self) -> Page:
+        version, page = self.__all
+        snapshot = self.__registry.snapshot
+        if version != snapshot.version:
+            page = Page(json.dumps({state.name: self.__as_dict(state) for state in snapshot.states}).encode("utf-8"))
+            self.__all = (snapshot.version, page)
+        return page
+
+    def json(self, name: str) -> Optional[Page]:
+        snapshot = self.__registry.snapshot
+        if snapshot.names is not self.__json_names:
+            # the device set has changed. Drop the pages of the removed devices
+            self.__json_names = snapshot.names
+            [self.__json.pop(cached_name, None) for cached_name in list(self.__json.keys()) if cached_name not in snapshot.by_name]
+        state = snapshot.by_name.get(name, None)
+        if state is None:
+            return None
+        cached = self.__json.get(name, None)
+        if cached is not None and cached[0] is state:
+            return cached[1]
+        page = Page(json.dumps(self.__as_dict(state)).encode("utf-8"))
+        self.__json[name] = (state, page)
+        return page
 
 
 class SimpleRequestHandler(BaseHTTPRequestHandler):
 
+    # keep-alive connections. Idle connections are closed after the timeout to release the connection slot
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+    # headers and body are written separately. Without TCP_NODELAY the body waits for the delayed ACK of the client
+    disable_nagle_algorithm = True
+
     def log_message(self, format, *args):
         # suppress access logging
         pass
 
     def do_GET(self):
-        presences: List[Presence] = self.server.presences
+        start = monotonic()
+        pages: PresencePages = self.server.pages
         parsed_url = urlparse(self.path)
+        query = parse_qs(parsed_url.query)
         presence_name = parsed_url.path.lstrip("/")
-        presence = next((s for s in presences if s.name == presence_name), None)
-        if presence:
-            self._send_json(200, {'is_presence': 'true' if presence.is_presence else 'false', 'last_seen': presence.last_time_presence.strftime("%Y-%m-%dT%H:%M")})
+        try:
+            wait_sec = parse_wait_sec(query)
+            since = int(query.get("since", ["0"])[0])
+        except ValueError:
+            self.send_error(400, "invalid query parameter")
+            return
+        if wait_sec > 0 and presence_name != "federation":
+            # long polls occupy a connection thread like event streams
+            if not self.server.acquire_waiter():
+                self.send_error(503, "too many waiting requests")
+                return
+            try:
+                self.__wait_for_transition(presence_name, wait_sec)
+            finally:
+                self.server.release_waiter()
+        page = pages.json(presence_name)
+        if page is not None:
+            self._send(page, "application/json")
+            HTTP_REQUEST.observe(monotonic() - start, "presence_wait" if wait_sec > 0 else "presence")
+        elif presence_name == "events":
+            self.__stream_events()
+        elif presence_name == "all":
+            self._send(pages.all(), "application/json")
+            HTTP_REQUEST.observe(monotonic() - start, "all")
+        elif presence_name == "federation" and self.server.federation is not None:
+            # the long polls of the peers are counted like other long polls
+            if not self.server.acquire_waiter():
+                self.send_error(503, "too many waiting requests")
+                return
+            try:
+                delta = self.server.federation.delta(query.get("epoch", [""])[0], since, wait_sec)
+            finally:
+                self.server.release_waiter()
+            self._send(Page(json.dumps(delta).encode("utf-8")), "application/json")
+        elif presence_name == "metrics":
+            self._send(Page(REGISTRY.render().encode("utf-8")), "text/plain; version=0.0.4; charset=utf-8")
+            HTTP_REQUEST.observe(monotonic() - start, "metrics")
         else:
-            html = "<h1>available presences</h1><ul>"
-            for s in presences:
-                html += f"<li><a href='/{s.name}'>{s.name}</a></li>"
-            html += "</ul>"
-            self._send_html(200, html)
-
-    def _send_html(self, status, message):
-        self.send_response(status)
-        self.send_header("Content-type", "text/html; charset=utf-8")
-        self.end_headers()
-        self.wfile.write(message.encode("utf-8"))
-
-    def _send_json(self, status, data: Dict[str, Any]):
-        self.send_response(status)
-        self.send_header("Content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(json.dumps(data).encode("utf-8"))
+            self._send(pages.index(), "text/html; charset=utf-8")
+            HTTP_REQUEST.observe(monotonic() - start, "index")
+
+    def __wait_for_transition(self, name: str, wait_sec: float):
+        # long poll: returns as soon as the presence state of the device flips or the wait time is elapsed
+        registry: PresenceRegistry = self.server.registry
+        snapshot = registry.snapshot
+        state = snapshot.by_name.get(name, None)
+        if state is not None:
+            deadline = monotonic() + wait_sec
+            while deadline > monotonic():
+                snapshot = registry.wait_for_change(snapshot.version, deadline - monotonic())
+                current = snapshot.by_name.get(name, None)
+                if current is None or current.status != state.status:
+                    break
+
+    def __stream_events(self):
+        # server-sent events stream of presence state transitions
+        if not self.server.acquire_waiter():
+            self.send_error(503, "too many waiting requests")
+            return
+        try:
+            self.close_connection = True
+            self.send_response(200)
+            self.send_header("Content-type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+            self.end_headers()
+            registry: PresenceRegistry = self.server.registry
+            snapshot = registry.snapshot
+            while True:
+                new_snapshot = registry.wait_for_change(snapshot.version, 15)
+                if new_snapshot.version == snapshot.version:
+                    self.wfile.write(b": keep-alive\n\n")
+                else:
+                    for state in new_snapshot.states:
+                        previous = snapshot.by_name.get(state.name, None)
+                        if previous is None or previous.status != state.status:
+                            data = json.dumps({'name': state.name, 'is_presence': IS_PRESENCE[state.status], 'last_seen': state.last_seen_str})
+                            self.wfile.write(("event: presence\ndata: " + data + "\n\n").encode("utf-8"))
+                    snapshot = new_snapshot
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError, TimeoutError):
+            pass
+        finally:
+            self.server.release_waiter()
+
+    def _send(self, page: Page, content_type: str):
+        if page.etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_header("ETag", page.etag)
+            self.end_headers()
+        else:
+            self.send_response(200)
+            self.send_header("Content-type", content_type)
+            self.send_header("Content-Length", str(len(page.body)))
+            self.send_header("ETag", page.etag)
+            self.end_headers()
+            self.wfile.write(page.body)
+
+
+class BoundedThreadingHTTPServer(ThreadingHTTPServer):
+    """
+    handles each connection by its own thread, so that idle keep-alive connections do not delay the
+    requests of other clients. The number of connections is capped. Exceeding connections are refused by 503
+    """
+
+    def __init__(self, address, handler_class, max_connections: int = 256):
+        super().__init__(address, handler_class)
+        self.__free_connections = threading.Semaphore(max_connections)
+        # event streams and long polls occupy a connection for a long time. Keep the other half of the connections for requests
+        self.__free_waiters = threading.Semaphore(max(1, max_connections // 2))
+
+    def process_request(self, request, client_address):
+        if self.__free_connections.acquire(blocking=False):
+            super().process_request(request, client_address)
+        else:
+            try:
+                request.sendall(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.__free_connections.release()
+
+    def acquire_waiter(self) -> bool:
+        return self.__free_waiters.acquire(blocking=False)
+
+    def release_waiter(self):
+        self.__free_waiters.release()
+
 
 class PresenceWebServer:
-    def __init__(self, presences: List[Presence],  host='0.0.0.0', port=8000):
+    def __init__(self, registry: PresenceRegistry,  host='0.0.0.0', port=8000, max_connections: int = 256, federation=None):
         self.host = host
         self.port = port
         self.address = (self.host, self.port)
-        self.server = HTTPServer(self.address, SimpleRequestHandler)
-        self.server.presences = presences
+        self.server = BoundedThreadingHTTPServer(self.address, SimpleRequestHandler, max_connections)
+        self.server.registry = registry
+        self.server.pages = PresencePages(registry)
+        self.server.federation = federation
         self.server_thread = None
 
     def start(self):
@@ -59,3 +258,216 @@ class PresenceWebServer:
         self.server.server_close()
         logging.info("web server stopped")
 
+
+
+class AsyncPresenceWebServer:
+    """
+    Serves the endpoints of PresenceWebServer within an asyncio event loop, without a thread per connection.
+    Used by the unified runtime. Like BoundedThreadingHTTPServer, the number of connections is capped and
+    exceeding connections are refused by 503. A request has to be received within the idle timeout
+    """
+
+    MAX_HEADERS = 100
+
+    def __init__(self, registry: PresenceRegistry, host='0.0.0.0', port=8000, loop: asyncio.AbstractEventLoop = None, federation=None, max_connections: int = 256):
+        self.host = host
+        self.port = port
+        self.registry = registry
+        self.pages = PresencePages(registry)
+        self.federation = federation
+        self.loop = asyncio.get_event_loop() if loop is None else loop
+        self.__free_connections = max_connections
+        # event streams and long polls occupy a connection for a long time. Keep the other half of the connections for requests
+        self.__free_waiters = max(1, max_connections // 2)
+        self.__server: Optional[asyncio.AbstractServer] = None
+        self.__changed: Optional[asyncio.Event] = None      # created by the first waiter, replaced on each change
+        registry.add_listener(self.__on_value_changed)
+        if federation is not None:
+            federation.add_listener(self.__on_value_changed)
+
+    def __on_value_changed(self, name: str):
+        if self.__changed is not None:
+            self.loop.call_soon_threadsafe(self.__notify_waiters)
+
+    def __notify_waiters(self):
+        changed, self.__changed = self.__changed, None
+        if changed is not None:
+            changed.set()
+
+    def __change_event(self) -> asyncio.Event:
+        if self.__changed is None:
+            self.__changed = asyncio.Event()
+        return self.__changed
+
+    async def __wait_for_change(self, version: int, timeout_sec: float) -> PresenceSnapshot:
+        changed = self.__change_event()
+        # the version is checked after publishing the event to not miss a change in between
+        if self.registry.snapshot.version == version:
+            try:
+                await asyncio.wait_for(changed.wait(), timeout_sec)
+            except asyncio.TimeoutError:
+                pass
+        return self.registry.snapshot
+
+    async def __read_request(self, reader: asyncio.StreamReader) -> Optional[Tuple[str, str, str, Dict[str, str]]]:
+        # returns None, if the client closed the connection
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        method, path, version = request_line.decode("latin-1").split()
+        headers: Dict[str, str] = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                return method, path, version, headers
+            if len(headers) >= self.MAX_HEADERS:
+                raise ValueError("too many headers")
+            key, value = line.decode("latin-1").split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+
+    async def __handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        if self.__free_connections <= 0:
+            writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            writer.close()
+            return
+        self.__free_connections -= 1
+        try:
+            while True:
+                # the request line and the headers are received within the idle timeout
+                request = await asyncio.wait_for(self.__read_request(reader), SimpleRequestHandler.timeout)
+                if request is None:
+                    break
+                method, path, version, headers = request
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                if method != "GET":
+                    self.__send(writer, headers, None, "", 501)
+                    keep_alive = False
+                elif not await self.__get(path, headers, writer):
+                    keep_alive = False
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.__free_connections += 1
+            writer.close()
+
+    async def __get(self, path: str, headers: Dict[str, str], writer: asyncio.StreamWriter) -> bool:
+        # returns false, if the connection is not reusable
+        start = monotonic()
+        parsed_url = urlparse(path)
+        query = parse_qs(parsed_url.query)
+        presence_name = parsed_url.path.lstrip("/")
+        try:
+            wait_sec = parse_wait_sec(query)
+            since = int(query.get("since", ["0"])[0])
+        except ValueError:
+            self.__send(writer, headers, None, "", 400)
+            return True
+        if wait_sec > 0 and presence_name != "federation":
+            if self.__free_waiters <= 0:
+                self.__send(writer, headers, None, "", 503)
+                return True
+            self.__free_waiters -= 1
+            try:
+                await self.__wait_for_transition(presence_name, wait_sec)
+            finally:
+                self.__free_waiters += 1
+        page = self.pages.json(presence_name)
+        if page is not None:
+            self.__send(writer, headers, page, "application/json")
+            HTTP_REQUEST.observe(monotonic() - start, "presence_wait" if wait_sec > 0 else "presence")
+        elif presence_name == "events":
+            await self.__stream_events(writer)
+            return False
+        elif presence_name == "all":
+            self.__send(writer, headers, self.pages.all(), "application/json")
+            HTTP_REQUEST.observe(monotonic() - start, "all")
+        elif presence_name == "federation" and self.federation is not None:
+            if self.__free_waiters <= 0:
+                self.__send(writer, headers, None, "", 503)
+                return True
+            self.__free_waiters -= 1
+            try:
+                delta = await self.__federation_delta(query.get("epoch", [""])[0], since, wait_sec)
+            finally:
+                self.__free_waiters += 1
+            self.__send(writer, headers, Page(json.dumps(delta).encode("utf-8")), "application/json")
+        elif presence_name == "metrics":
+            self.__send(writer, headers, Page(REGISTRY.render().encode("utf-8")), "text/plain; version=0.0.4; charset=utf-8")
+            HTTP_REQUEST.observe(monotonic() - start, "metrics")
+        else:
+            self.__send(writer, headers, self.pages.index(), "text/html; charset=utf-8")
+            HTTP_REQUEST.observe(monotonic() - start, "index")
+        return True
+
+    async def __federation_delta(self, epoch: str, since: int, wait_sec: float) -> Dict:
+        # long poll of a peer. The federation notifies about local changes like the registry
+        deadline = monotonic() + wait_sec
+        while True:
+            changed = self.__change_event()
+            delta = self.federation.delta(epoch, since, 0)
+            remaining = deadline - monotonic()
+            if delta["states"] or remaining <= 0:
+                return delta
+            try:
+                await asyncio.wait_for(changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+
+    async def __wait_for_transition(self, name: str, wait_sec: float):
+        snapshot = self.registry.snapshot
+        state = snapshot.by_name.get(name, None)
+        if state is not None:
+            deadline = monotonic() + wait_sec
+            while deadline > monotonic():
+                snapshot = await self.__wait_for_change(snapshot.version, deadline - monotonic())
+                current = snapshot.by_name.get(name, None)
+                if current is None or current.status != state.status:
+                    break
+
+    async def __stream_events(self, writer: asyncio.StreamWriter):
+        if self.__free_waiters <= 0:
+            writer.write(b"HTTP/1.1 503 too many waiting requests\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+            return
+        self.__free_waiters -= 1
+        try:
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-type: text/event-stream\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n")
+            snapshot = self.registry.snapshot
+            while True:
+                new_snapshot = await self.__wait_for_change(snapshot.version, 15)
+                if new_snapshot.version == snapshot.version:
+                    writer.write(b": keep-alive\n\n")
+                else:
+                    for state in new_snapshot.states:
+                        previous = snapshot.by_name.get(state.name, None)
+                        if previous is None or previous.status != state.status:
+                            data = json.dumps({'name': state.name, 'is_presence': IS_PRESENCE[state.status], 'last_seen': state.last_seen_str})
+                            writer.write(("event: presence\ndata: " + data + "\n\n").encode("utf-8"))
+                    snapshot = new_snapshot
+                await writer.drain()
+        finally:
+            self.__free_waiters += 1
+
+    @staticmethod
+    def __send(writer: asyncio.StreamWriter, headers: Dict[str, str], page: Optional[Page], content_type: str, status: int = 200):
+        if page is None:
+            writer.write(("HTTP/1.1 " + str(status) + " " + HTTPStatus(status).phrase + "\r\nContent-Length: 0\r\n\r\n").encode("latin-1"))
+        elif page.etag in headers.get("if-none-match", ""):
+            writer.write(("HTTP/1.1 304 Not Modified\r\nETag: " + page.etag + "\r\n\r\n").encode("latin-1"))
+        else:
+            writer.write(("HTTP/1.1 200 OK\r\nContent-type: " + content_type + "\r\nContent-Length: " + str(len(page.body)) + "\r\nETag: " + page.etag + "\r\n\r\n").encode("latin-1") + page.body)
+
+    async def __serve(self):
+        # asyncio streams set TCP_NODELAY
+        self.__server = await asyncio.start_server(self.__handle, self.host, self.port)
+        logging.info(f"web server started http://{self.host}:{self.port} (event loop)")
+
+    def start(self):
+        self.loop.call_soon_threadsafe(self.loop.create_task, self.__serve())
+
+    def stop(self):
+        if self.__server is not None:
+            self.loop.call_soon_threadsafe(self.__server.close)
+        logging.info("web server stopped")
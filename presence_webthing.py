@@ -1,138 +1,284 @@
-import sys
+import os
+import re
+import asyncio
 import logging
-import tornado.ioloop
-from typing import Dict
-from webthing import (MultipleThings, Property, Thing, Value, WebThingServer)
-from presence import Presence, IpPresence, Presences
+import argparse
+from time import monotonic, sleep
+from datetime import datetime
+from threading import Thread, Event
+from typing import Callable, Dict, List, Tuple
+from presence import Presence, IpPresence, SniffPresence, Presences
+from probe import default_probe_engine
 from redzoo.math.display import duration
-from presence_web import PresenceWebServer
-from presence_mcp import PresenceMCPServer
-
-
-class PresenceThing(Thing):
-
-    # regarding capabilities refer https://iot.mozilla.org/schemas
-    # there is also another schema registry http://iotschema.org/docs/full.html not used by webthing
-
-    def __init__(self, description: str, presence: Presence):
-        Thing.__init__(
-            self,
-            'urn:dev:ops:presence-1',
-            'presence_' + presence.name,
-            ['MultiLevelSensor'],
-            description
-        )
-        self.ioloop = tornado.ioloop.IOLoop.current()
-        self.presence = presence
-        self.presence.add_listener(self.on_value_changed)
-
-        self.name = Value(presence.name)
-        self.add_property(
-            Property(self,
-                     'name',
-                     self.name,
-                     metadata={
-                         'title': 'name',
-                         "type": "string",
-                         'description': 'the device name',
-                         'readOnly': True,
-                     }))
-
-        self.addr = Value(presence.addr)
-        self.add_property(
-            Property(self,
-                     'addr',
-                     self.addr,
-                     metadata={
-                         'title': 'addr',
-                         "type": "string",
-                         'description': 'the device address',
-                         'readOnly': True,
-                     }))
-
-        self.is_presence = Value(presence.is_presence)
-        self.add_property(
-            Property(self,
-                     'is_presence',
-                     self.is_presence,
-                     metadata={
-                         'title': 'is_presence',
-                         "type": "boolean",
-                         'description': 'true, if presence',
-                         'readOnly': True,
-                     }))
-
-        self.last_time_presence = Value(presence.last_time_presence.strftime("%Y-%m-%dT%H:%M"))
-        self.add_property(
-            Property(self,
-                     'last_time_presence_utc',
-                     self.last_time_presence,
-                     metadata={
-                         'title': 'last_time_presence_utc',
-                         "type": "string",
-                         'description': 'the last time presence ISO8601 string (UTC)',
-                         'readOnly': True,
-                     }))
-
-        self.elapsed_since_last_seen = Value(duration(presence.age_sec, 1))
-        self.add_property(
-            Property(self,
-                     'elapsed_since_last_seen',
-                     self.elapsed_since_last_seen,
-                     metadata={
-                         'title': 'elapsed_since_last_seen',
-                         "type": "string",
-                         'description': 'elapsed time since last seen',
-                         'readOnly': True,
-                     }))
-
-
-    def on_value_changed(self, name: str):
-        self.ioloop.add_callback(self._on_value_changed)
-
-    def _on_value_changed(self):
-        self.last_time_presence.notify_of_external_update(self.presence.last_time_presence.strftime("%Y-%m-%dT%H:%M"))
-        self.elapsed_since_last_seen.notify_of_external_update(duration(self.presence.age_sec, 1))
-        self.is_presence.notify_of_external_update(self.presence.is_presence)
-
-
-def run_server(description: str, port: int, name_address_map: Dict[str, str], timeout_sec :int):
-    if len(name_address_map) < 2:
-        presences = [IpPresence(dev_name, name_address_map[dev_name], timeout_sec) for dev_name in name_address_map.keys()]
+from registry import PresenceRegistry
+from history import PresenceHistory
+from metrics import process_age_sec, process_rss_bytes
+from presence_web import PresenceWebServer, AsyncPresenceWebServer
+from federation import PresenceFederation
+
+
+GROUP = re.compile(r"^(any|all)\((.*)\)$")
+FRONTENDS = ("webthing", "http", "mcp")
+
+
+def create_presence(name: str, addr: str, timeout_sec: int, last_time_presence: datetime = None) -> Presence:
+    if addr.startswith("passive:"):
+        # passive detection by sniffing ARP/DHCP/mDNS traffic of the MAC or IP address
+        return SniffPresence(name, addr[len("passive:"):], timeout_sec, last_time_presence=last_time_presence)
     else:
-        presences = [IpPresence(dev_name, name_address_map[dev_name], timeout_sec) for dev_name in name_address_map.keys()]
-        presences = [Presences("any", presences, timeout_sec)] + presences
-    shutters_tings = [PresenceThing(description, presence) for presence in presences]
-    web_server = PresenceWebServer(presences, port=port+1)
-    mcp_server = PresenceMCPServer("presence", port+2, presences)
-    server = WebThingServer(MultipleThings(shutters_tings, "presence"), port=port, disable_host_validation=True)
+        return IpPresence(name, addr, timeout_sec, last_time_presence=last_time_presence)
+
+
+class PresenceSet:
+    """
+    The presences of the device configuration. A config value like any(alice,bob) or all(alice,bob)
+    defines a group of devices and/or other groups. Loading a changed configuration keeps the presences
+    of the unchanged devices and groups, so that only the changed devices are started or stopped
+    """
+
+    def __init__(self, timeout_sec: int, history: PresenceHistory = None, federation: PresenceFederation = None):
+        self.timeout_sec = timeout_sec
+        self.__history = history
+        self.__federation = federation
+        self.__addrs: Dict[str, str] = dict()
+        self.__devices: Dict[str, Presence] = dict()
+        self.__groups: Dict[str, Presences] = dict()
+        self.presences: List[Presence] = []
+
+    @staticmethod
+    def group_definitions(name_address_map: Dict[str, str]) -> Dict[str, Tuple[str, List[str]]]:
+        devices = [name for name, addr in name_address_map.items() if not GROUP.match(addr)]
+        groups = {name: (GROUP.match(addr).group(1), [member.strip() for member in GROUP.match(addr).group(2).split(",")])
+                  for name, addr in name_address_map.items() if GROUP.match(addr)}
+        if not groups and len(devices) > 1:
+            groups = {"any": ("any", devices)}
+
+        def validate(name: str, path: List[str]):
+            if name in path:
+                raise ValueError("cyclic group definition " + " -> ".join(path + [name]))
+            if name in groups:
+                [validate(member, path + [name]) for member in groups[name][1]]
+            elif name not in devices:
+                raise ValueError("unknown group member " + name + " of " + path[-1])
+
+        [validate(name, []) for name in groups.keys()]
+        return groups
+
+    def load(self, name_address_map: Dict[str, str]) -> Tuple[List[Presence], List[Presence]]:
+        """
+        applies the configuration and returns the added and the removed presences. An invalid configuration
+        raises a ValueError without changing any presence
+        """
+        group_definitions = self.group_definitions(name_address_map)
+        addrs = {name: addr for name, addr in name_address_map.items() if not GROUP.match(addr)}
+        added: List[Presence] = []
+        removed: List[Presence] = []
+        for name in list(self.__devices.keys()):
+            if addrs.get(name, None) != self.__addrs[name]:
+                removed.append(self.__devices.pop(name))
+                if self.__federation is not None:
+                    self.__federation.forget(removed[-1])
+        for name in list(self.__groups.keys()):
+            if name not in group_definitions or group_definitions[name][0] != self.__groups[name].mode:
+                removed.append(self.__groups.pop(name))
+        for name, addr in addrs.items():
+            if name not in self.__devices:
+                device = create_presence(name, addr, self.timeout_sec, None if self.__history is None else self.__history.last_seen(name))
+                if self.__federation is not None:
+                    device = self.__federation.federate(device)
+                self.__devices[name] = device
+                added.append(device)
+        self.__addrs = addrs
+
+        def resolve(name: str) -> Presence:
+            if name in self.__devices:
+                return self.__devices[name]
+            mode, member_names = group_definitions[name]
+            members = [resolve(member) for member in member_names]
+            group = self.__groups.get(name, None)
+            if group is None:
+                group = Presences(name, members, self.timeout_sec, mode)
+                self.__groups[name] = group
+                added.append(group)
+            elif group.members != members:
+                group.set_members(members)
+            return group
+
+        groups = [resolve(name) for name in group_definitions.keys()]
+        self.presences = groups + [self.__devices[name] for name in addrs.keys()]
+        return added, removed
+
+
+class DeviceConfigWatcher:
+    """
+    Polls the modification time of the device configuration file and reports the changed configuration
+    """
+
+    def __init__(self, filename: str, on_changed: Callable[[Dict[str, str]], None], interval_sec: int = 5):
+        self.filename = filename
+        self.__on_changed = on_changed
+        self.__interval_sec = interval_sec
+        self.__mtime = os.path.getmtime(filename)
+        self.__is_running = True
+        Thread(target=self.__watch_loop, daemon=True).start()
+
+    def __watch_loop(self):
+        while self.__is_running:
+            sleep(self.__interval_sec)
+            try:
+                mtime = os.path.getmtime(self.filename)
+                if mtime != self.__mtime:
+                    self.__mtime = mtime
+                    logging.info("device configuration " + self.filename + " changed. Reloading")
+                    self.__on_changed(load_devices(self.filename))
+            except Exception as e:
+                logging.warning("error occurred on reloading " + self.filename + " " + str(e), exc_info=True)
+
+    def stop(self):
+        self.__is_running = False
+
+
+def log_when_determined(registry: PresenceRegistry, start_time: float):
+    # logs once, when the state of all presences is determined (e.g. the initial probe round is completed)
+    is_logged = False
+
+    def on_value_changed(name: str):
+        nonlocal is_logged
+        if not is_logged and all(state.is_known for state in registry.snapshot.states):
+            is_logged = True
+            logging.info("state of all presences determined after " + str(round(monotonic() - start_time, 1)) + " sec")
+
+    registry.add_listener(on_value_changed)
+    on_value_changed("")
+
+
+def run_server(description: str, port: int, name_address_map: Dict[str, str], timeout_sec :int, history_file: str = None, nodes: List[str] = None, config_file: str = None, unified: bool = False, frontends: Tuple[str, ...] = FRONTENDS):
+    start_time = monotonic()
+    unsupported = set(frontends) - set(FRONTENDS)
+    if unsupported:
+        raise ValueError("unsupported front-end " + ", ".join(sorted(unsupported)))
+    # the front-ends are imported on demand. Their dependencies (tornado/webthing, fastmcp) are slow to load
+    is_webthing = "webthing" in frontends
+    if is_webthing:
+        import tornado.ioloop
+        from webthing import MultipleThings, WebThingServer
+        from presence_thing import PresenceThing, ThingPublisher
+    # unified runtime: the probe engine, the HTTP and the MCP server run within a single asyncio loop (the one of the webthing server, if enabled)
+    loop = None
+    if unified:
+        loop = tornado.ioloop.IOLoop.current().asyncio_loop if is_webthing else asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        default_probe_engine().run_on(loop)
+    history = None if history_file is None else PresenceHistory(history_file)
+    # nodes: the HTTP addresses (host:port) of all federation nodes, starting with this node
+    federation = None if not nodes else PresenceFederation(nodes[0], nodes[1:])
+    presence_set = PresenceSet(timeout_sec, history, federation)
+    presence_set.load(name_address_map)
+    presences = presence_set.presences
+    if history is not None:
+        [history.observe(presence) for presence in presences]
+    registry = PresenceRegistry(presences)
+    log_when_determined(registry, start_time)
+
+    servers = []
+    if "http" in frontends or federation is not None:
+        # the federation nodes exchange their state by the HTTP server
+        if loop is None:
+            servers.append(PresenceWebServer(registry, port=port+1, federation=federation))
+        else:
+            servers.append(AsyncPresenceWebServer(registry, port=port+1, loop=loop, federation=federation))
+    if "mcp" in frontends:
+        from presence_mcp import PresenceMCPServer
+        servers.append(PresenceMCPServer("presence", port+2, registry, history, loop=loop))
+    publisher = None
+    thing_server = None
+    if is_webthing:
+        shutters_tings = [PresenceThing(description, presence, registry) for presence in presences]
+        publisher = ThingPublisher(registry, shutters_tings)
+        thing_server = WebThingServer(MultipleThings(shutters_tings, "presence"), port=port, disable_host_validation=True)
+
+    def reload(new_name_address_map: Dict[str, str]):
+        added, removed = presence_set.load(new_name_address_map)
+        [presence.stop() for presence in removed]
+        if history is not None:
+            [history.observe(presence) for presence in added]
+        registry.update(presence_set.presences)
+        [presence.start() for presence in added]
+        if publisher is not None:
+            publisher.ioloop.add_callback(publisher.update, lambda presence: PresenceThing(description, presence, registry))
+        logging.info("device configuration reloaded (" + str(len(added)) + " presences added, " + str(len(removed)) + " removed)")
+
+    watcher = None
     try:
-        logging.info('starting the server http://localhost:' + str(port) + " (absent threshold: " + duration(timeout_sec) + ")")
+        logging.info("starting the servers " + ", ".join(frontends) + " (absent threshold: " + duration(timeout_sec) + ")")
         [presence.start() for presence in presences]
-        web_server.start()
-        mcp_server.start()
-        server.start()
+        [server.start() for server in servers]
+        if federation is not None:
+            federation.start()
+        if config_file is not None:
+            watcher = DeviceConfigWatcher(config_file, reload)
+        logging.info("servers started after " + str(round(monotonic() - start_time, 1)) + " sec (presence state is probed in the background)")
+        logging.info("startup completed " + str(round(process_age_sec(), 1)) + " sec after the process start (including imports). Resident memory " + str(round(process_rss_bytes() / 1024 / 1024, 1)) + " MB")
+        if thing_server is not None:
+            logging.info('webthing server http://localhost:' + str(port))
+            thing_server.start()
+        elif loop is not None:
+            loop.run_forever()
+        else:
+            Event().wait()
     except KeyboardInterrupt:
         logging.info('stopping the server')
-        [presence.stop() for presence in presences]
-        web_server.stop()
-        mcp_server.stop()
-        server.stop()
+        if watcher is not None:
+            watcher.stop()
+        [presence.stop() for presence in presence_set.presences]
+        if federation is not None:
+            federation.stop()
+        [server.stop() for server in servers]
+        if thing_server is not None:
+            thing_server.stop()
+        if history is not None:
+            history.close()
         logging.info('done')
 
 
 
 def parse_devices(config: str) -> Dict[str, str]:
+    # devices are separated by & or (in a configuration file) by line breaks
     name_address_map = {}
-    for device in config.split("&"):
-        name, address = device.split('=')
-        name_address_map[name.strip()] = address.strip()
+    for device in re.split(r"[&\n]", config):
+        if device.strip() and not device.strip().startswith("#"):
+            name, address = device.split('=')
+            name_address_map[name.strip()] = address.strip()
     return name_address_map
 
 
+def load_devices(filename: str) -> Dict[str, str]:
+    with open(filename) as file:
+        return parse_devices(file.read())
+
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(name)-20s: %(levelname)-8s %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
     logging.getLogger('tornado.access').setLevel(logging.ERROR)
     logging.getLogger('urllib3.connectionpool').setLevel(logging.WARNING)
     logging.getLogger('scapy.runtime').setLevel(logging.ERROR)
-    run_server("description", int(sys.argv[1]), parse_devices(sys.argv[2]), int(sys.argv[3]))
+    parser = argparse.ArgumentParser(description="detects the presence of devices in the local network")
+    parser.add_argument("port", type=int, help="port of the webthing server. The HTTP server listens on port+1, the MCP server on port+2")
+    parser.add_argument("devices", help="name=address pairs separated by &, or the path of a device configuration file, which is reloaded on changes")
+    parser.add_argument("timeout_sec", type=int, help="time without any answer after which a device is absent")
+    parser.add_argument("history_file", nargs="?", help="SQLite file of the presence history")
+    parser.add_argument("nodes", nargs="?", help="comma separated host:port of the HTTP servers of all federation nodes, starting with this node")
+    parser.add_argument("--frontends", default=",".join(FRONTENDS), help="comma separated front-ends to serve (default: %(default)s)")
+    parser.add_argument("--asyncio", action="store_true", help="runs the probe engine and the servers within a single asyncio loop")
+    args = parser.parse_args()
+    devices_config_file = args.devices if os.path.isfile(args.devices) else None
+    devices = parse_devices(args.devices) if devices_config_file is None else load_devices(devices_config_file)
+    run_server("description",
+               args.port,
+               devices,
+               args.timeout_sec,
+               args.history_file or None,
+               args.nodes.split(",") if args.nodes else None,
+               devices_config_file,
+               args.asyncio,
+               tuple(frontend.strip() for frontend in args.frontends.split(",") if frontend.strip()))
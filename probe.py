@@ -0,0 +1,841 @@
+import os
+import errno
+import asyncio
+import heapq
+import random
+import selectors
+import socket
+import struct
+import logging
+from threading import Thread, Lock, Event, Condition, Semaphore
+from queue import Queue
+from time import monotonic, sleep
+from typing import Dict, Iterable, List, Optional, Protocol, Set, Tuple
+from metrics import REGISTRY, Counter, Histogram
+
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+PROBES = REGISTRY.register(Counter("presence_probes_total", "sent echo requests", ("addr",)))
+PROBE_REPLIES = REGISTRY.register(Counter("presence_probe_replies_total", "answered echo requests", ("addr",)))
+PROBE_RTT = REGISTRY.register(Histogram("presence_probe_rtt_seconds", "round trip time of the answered echo requests", ("addr",)))
+PROBE_STEP = REGISTRY.register(Histogram("presence_probe_step_seconds", "time spent sending a batch of echo requests and waiting for the replies"))
+PROBE_SIGNALS = REGISTRY.register(Counter("presence_probe_signals_total", "answered probes by the signal which answered", ("signal",)))
+PROBE_LOOP_LAG = REGISTRY.register(Histogram("presence_probe_loop_lag_seconds", "delay between the due time of a probe and its start"))
+
+
+def _checksum(data: bytes) -> int:
+    if len(data) % 2:
+        data += b'\x00'
+    total = sum(struct.unpack("!%dH" % (len(data) // 2), data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+class IcmpProber:
+    """
+    Sends ICMP echo requests to many hosts at once over a single socket and matches the
+    replies by ICMP id/seq. A raw socket is used if permitted, otherwise the unprivileged
+    ICMP datagram socket (see net.ipv4.ping_group_range).
+    Concurrent calls share the socket. The received replies are dispatched to the waiting call by seq
+    """
+
+    def __init__(self):
+        self.__lock = Lock()
+        self.__replied = Condition(self.__lock)
+        self.__ident = os.getpid() & 0xFFFF
+        self.__seq = 0
+        self.__pending: Dict[int, Tuple[str, str, float, Dict[str, float]]] = dict()   # seq -> (addr, ip, send time, rtts of the call)
+        self.__is_receiving = False
+        self.__async_calls: List[Tuple[Dict[str, float], int, asyncio.Event]] = []
+        try:
+            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            self.__is_raw = True
+        except PermissionError:
+            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            self.__is_raw = False
+        self.__sock.setblocking(False)
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__sock, selectors.EVENT_READ)
+
+    def __next_seq(self) -> int:
+        self.__seq = (self.__seq + 1) & 0xFFFF
+        return self.__seq
+
+    def __packet(self, seq: int) -> bytes:
+        payload = b'presence'
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, 0, self.__ident, seq)
+        header = struct.pack("!BBHHH", ICMP_ECHO_REQUEST, 0, _checksum(header + payload), self.__ident, seq)
+        return header + payload
+
+    def __parse_reply(self, data: bytes):
+        if self.__is_raw:
+            data = data[(data[0] & 0x0F) * 4:]    # strip the IP header
+        if len(data) < 8:
+            return None
+        icmp_type, _, _, ident, seq = struct.unpack("!BBHHH", data[:8])
+        if icmp_type != ICMP_ECHO_REPLY:
+            return None
+        if self.__is_raw and ident != self.__ident:
+            return None                            # the kernel rewrites the id of datagram sockets
+        return seq
+
+    @staticmethod
+    def __resolve(addr: str) -> str:
+        try:
+            socket.inet_aton(addr)
+            return addr
+        except OSError:
+            return socket.gethostbyname(addr)
+
+    def __send(self, addrs: Iterable[str], rtts: Dict[str, float]) -> List[int]:
+        # requires lock. Returns the seqs of the sent requests
+        seqs = []
+        for addr in set(addrs):
+            try:
+                ip = self.__resolve(addr)
+                seq = self.__next_seq()
+                self.__sock.sendto(self.__packet(seq), (ip, 0))
+                self.__pending[seq] = (addr, ip, monotonic(), rtts)
+                seqs.append(seq)
+            except OSError as e:
+                logging.debug("could not send echo request to " + addr + " " + str(e))
+        return seqs
+
+    def __receive(self):
+        # requires lock. Reads all received replies without blocking
+        while True:
+            try:
+                data, (src, _) = self.__sock.recvfrom(2048)
+            except (BlockingIOError, InterruptedError):
+                break
+            seq = self.__parse_reply(data)
+            entry = self.__pending.get(seq)
+            if entry is not None and entry[1] == src:
+                del self.__pending[seq]
+                entry[3][entry[0]] = monotonic() - entry[2]
+
+    def ping(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        """
+        pings all addresses in one batch and returns the round trip time (sec) of each answered address
+        """
+        rtts: Dict[str, float] = {}
+        with self.__lock:
+            seqs = self.__send(addrs, rtts)
+            deadline = monotonic() + timeout
+            try:
+                while len(rtts) < len(seqs):
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                    if self.__is_receiving:
+                        # another call reads the socket and notifies about the replies
+                        self.__replied.wait(remaining)
+                        continue
+                    self.__is_receiving = True
+                    self.__lock.release()
+                    try:
+                        is_readable = len(self.__selector.select(remaining)) > 0
+                    finally:
+                        self.__lock.acquire()
+                        self.__is_receiving = False
+                    if is_readable:
+                        self.__receive()
+                    self.__replied.notify_all()
+            finally:
+                [self.__pending.pop(seq, None) for seq in seqs]
+            return dict(rtts)
+
+    def __on_readable(self):
+        with self.__lock:
+            self.__receive()
+        for rtts, expected, answered in self.__async_calls:
+            if len(rtts) >= expected:
+                answered.set()
+
+    async def ping_async(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        """
+        like ping(), but waits for the replies within the running event loop. Must not be mixed with
+        concurrent ping() calls
+        """
+        loop = asyncio.get_running_loop()
+        rtts: Dict[str, float] = {}
+        with self.__lock:
+            seqs = self.__send(addrs, rtts)
+        call = (rtts, len(seqs), asyncio.Event())
+        if not self.__async_calls:
+            loop.add_reader(self.__sock.fileno(), self.__on_readable)
+        self.__async_calls.append(call)
+        try:
+            if seqs:
+                await asyncio.wait_for(call[2].wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.__async_calls.remove(call)
+            if not self.__async_calls:
+                loop.remove_reader(self.__sock.fileno())
+            with self.__lock:
+                [self.__pending.pop(seq, None) for seq in seqs]
+        return dict(rtts)
+
+    def close(self):
+        self.__selector.close()
+        self.__sock.close()
+
+
+class Prober(Protocol):
+    """
+    ping() is called concurrently by several probe steps (ping_async() within the event loop)
+    """
+
+    def ping(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        ...
+
+    async def ping_async(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        ...
+
+
+# see linux/neighbour.h and linux/rtnetlink.h
+RTM_NEWROUTE = 24
+RTM_GETROUTE = 26
+RTM_NEWNEIGH = 28
+RTM_GETNEIGH = 30
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+NDA_DST = 1
+NDA_CACHEINFO = 3
+NUD_INCOMPLETE = 0x01
+NUD_FAILED = 0x20
+NUD_NOARP = 0x40
+RTA_DST = 1
+RTA_GATEWAY = 5
+RTN_UNICAST = 1
+RT_SCOPE_LINK = 253
+
+
+class NeighborTable:
+    """
+    Reads the IPv4 neighbor (ARP) table of the kernel by netlink. Other than /proc/net/arp, which lists
+    stale entries as complete as well, netlink provides the time since the kernel confirmed the entry,
+    i.e. since the host answered an ARP request or acknowledged traffic.
+    The connected routes tell which hosts are on-link, i.e. reachable without a router in between
+    """
+
+    def __init__(self, routes_ttl_sec: float = 30):
+        self.__lock = Lock()
+        self.__seq = 0
+        self.__clock_ticks = os.sysconf("SC_CLK_TCK")
+        self.__sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self.__routes_ttl_sec = routes_ttl_sec
+        self.__networks: List[Tuple[int, int]] = []     # (network, netmask) of the connected routes
+        self.__networks_expiry = 0.0
+
+    def __dump(self, request_type: int, reply_type: int, payload: bytes) -> List[bytes]:
+        # returns the payloads of the reply messages
+        with self.__lock:
+            self.__seq += 1
+            self.__sock.send(struct.pack("=LHHLL", 16 + len(payload), request_type, NLM_F_REQUEST | NLM_F_DUMP, self.__seq, 0) + payload)
+            messages = []
+            while True:
+                data = self.__sock.recv(65536)
+                offset = 0
+                while offset + 16 <= len(data):
+                    msg_len, msg_type, _, seq, _ = struct.unpack_from("=LHHLL", data, offset)
+                    if msg_type in (NLMSG_DONE, NLMSG_ERROR):
+                        return messages
+                    if msg_type == reply_type and seq == self.__seq:
+                        messages.append(data[offset + 16:offset + msg_len])
+                    offset += (msg_len + 3) & ~3
+
+    @staticmethod
+    def __attributes(data: bytes, offset: int) -> Dict[int, bytes]:
+        attributes = dict()
+        while offset + 4 <= len(data):
+            attr_len, attr_type = struct.unpack_from("=HH", data, offset)
+            if attr_len < 4:
+                break
+            attributes[attr_type] = data[offset + 4:offset + attr_len]
+            offset += (attr_len + 3) & ~3
+        return attributes
+
+    def confirmed_age(self) -> Dict[str, float]:
+        """
+        returns the seconds since the last confirmation of each resolved IPv4 neighbor
+        """
+        ages: Dict[str, float] = dict()
+        ndmsg = struct.pack("=BBHiHBB", socket.AF_INET, 0, 0, 0, 0, 0, 0)
+        for data in self.__dump(RTM_GETNEIGH, RTM_NEWNEIGH, ndmsg):
+            family, _, _, _, state, _, _ = struct.unpack_from("=BBHiHBB", data)
+            if family != socket.AF_INET or state & (NUD_INCOMPLETE | NUD_FAILED | NUD_NOARP):
+                continue
+            attributes = self.__attributes(data, 12)
+            if NDA_DST in attributes and NDA_CACHEINFO in attributes:
+                ages[socket.inet_ntoa(attributes[NDA_DST][:4])] = struct.unpack_from("=L", attributes[NDA_CACHEINFO])[0] / self.__clock_ticks
+        return ages
+
+    def __connected_networks(self) -> List[Tuple[int, int]]:
+        now = monotonic()
+        if now >= self.__networks_expiry:
+            networks = []
+            rtmsg = struct.pack("=BBBBBBBBL", socket.AF_INET, 0, 0, 0, 0, 0, 0, 0, 0)
+            for data in self.__dump(RTM_GETROUTE, RTM_NEWROUTE, rtmsg):
+                family, dst_len, _, _, _, _, scope, route_type, _ = struct.unpack_from("=BBBBBBBBL", data)
+                if family != socket.AF_INET or route_type != RTN_UNICAST or scope != RT_SCOPE_LINK:
+                    continue
+                attributes = self.__attributes(data, 12)
+                if RTA_GATEWAY in attributes:
+                    continue
+                netmask = (0xFFFFFFFF << (32 - dst_len)) & 0xFFFFFFFF
+                network = struct.unpack("!L", attributes.get(RTA_DST, b"\x00\x00\x00\x00")[:4])[0] & netmask
+                networks.append((network, netmask))
+            self.__networks, self.__networks_expiry = networks, now + self.__routes_ttl_sec
+        return self.__networks
+
+    def on_link(self, addrs: Iterable[str]) -> Set[str]:
+        """
+        returns the IPv4 addresses which are within a connected network or have a neighbor entry
+        """
+        networks = self.__connected_networks()
+        neighbors = self.confirmed_age()
+        on_link = set()
+        for addr in addrs:
+            ip = struct.unpack("!L", socket.inet_aton(addr))[0]
+            if addr in neighbors or any(ip & netmask == network for network, netmask in networks):
+                on_link.add(addr)
+        return on_link
+
+    def close(self):
+        self.__sock.close()
+
+
+class TcpProber:
+    """
+    Unprivileged probe by TCP connects to IP addresses. A host is alive, if the connect succeeds or is refused (RST).
+    Connects to several ports of a host are made concurrently, the first answer counts.
+    62078 (iphone-sync) is answered by iOS devices, other hosts typically reset the connection.
+    The answer is not verified to come from the host. A firewall rejecting by RST or a transparent proxy
+    answers for hosts behind it, so only on-link hosts should be probed
+    """
+
+    def __init__(self, ports: Tuple[int, ...] = (62078,)):
+        self.ports = ports
+
+    def ping(self, addrs: Iterable[str], timeout: float = 1) -> Dict[str, float]:
+        rtts: Dict[str, float] = {}
+        # other than select(), selectors are not limited to FD_SETSIZE sockets
+        selector = selectors.DefaultSelector()
+        try:
+            for addr in set(addrs):
+                for port in self.ports:
+                    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    result = sock.connect_ex((addr, port))
+                    if result in (0, errno.EINPROGRESS, errno.ECONNREFUSED):
+                        selector.register(sock, selectors.EVENT_WRITE, (addr, monotonic()))
+                    else:
+                        sock.close()
+
+            deadline = monotonic() + timeout
+            while selector.get_map():
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                events = selector.select(remaining)
+                if not events:
+                    break
+                for key, _ in events:
+                    addr, start = key.data
+                    selector.unregister(key.fileobj)
+                    if key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) in (0, errno.ECONNREFUSED):
+                        rtts.setdefault(addr, monotonic() - start)
+                    key.fileobj.close()
+        finally:
+            [key.fileobj.close() for key in list(selector.get_map().values())]
+            selector.close()
+        return rtts
+
+    async def ping_async(self, addrs: Iterable[str], timeout: float = 1) -> Dict[str, float]:
+        loop = asyncio.get_running_loop()
+        rtts: Dict[str, float] = {}
+
+        async def connect(addr: str, port: int):
+            start = monotonic()
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+                sock.setblocking(False)
+                try:
+                    await loop.sock_connect(sock, (addr, port))
+                except ConnectionRefusedError:
+                    pass
+                except OSError:
+                    return
+                rtts.setdefault(addr, monotonic() - start)
+
+        tasks = [loop.create_task(connect(addr, port)) for addr in set(addrs) for port in self.ports]
+        if tasks:
+            _, not_done = await asyncio.wait(tasks, timeout=timeout)
+            [task.cancel() for task in not_done]
+        return rtts
+
+
+def _is_ip(addr: str) -> bool:
+    try:
+        socket.inet_aton(addr)
+        return True
+    except OSError:
+        return False
+
+
+class MultiSignalProber:
+    """
+    Fuses several signals per host, the cheapest first. Hosts whose neighbor entry was confirmed recently
+    are answered without sending anything. The other on-link hosts get a TCP connect probe, which triggers an
+    ARP resolution as well. Hosts answering ARP but dropping TCP (e.g. sleeping iOS devices) are detected by
+    re-reading the neighbor table. The remaining hosts, including all hosts behind a router, get an ICMP
+    echo request. Host names are resolved once per resolve_ttl_sec, so that all signals get IP addresses.
+    Signals not permitted on this host are disabled. Without netlink, the ARP and the TCP signal are disabled
+    """
+
+    def __init__(self, tcp_ports: Tuple[int, ...] = (62078,), neighbor_max_age_sec: float = 10, tcp_timeout_sec: float = 1, resolve_ttl_sec: float = 300):
+        self.__neighbor_max_age_sec = neighbor_max_age_sec
+        self.__tcp_timeout_sec = tcp_timeout_sec
+        self.__resolve_ttl_sec = resolve_ttl_sec
+        self.__tcp = TcpProber(tcp_ports)
+        self.__lock = Lock()
+        self.__resolved: Dict[str, Tuple[Optional[str], float]] = dict()     # host name -> (IP address, expiry time)
+        try:
+            self.__neighbors: Optional[NeighborTable] = NeighborTable()
+        except OSError as e:
+            logging.warning("neighbor table not readable. ARP and TCP signal disabled " + str(e))
+            self.__neighbors = None
+        self.__icmp: Optional[IcmpProber] = None
+        self.__is_icmp_permitted = True
+
+    def __expired_names(self, addrs: Iterable[str]) -> List[str]:
+        now = monotonic()
+        return [addr for addr in addrs if not _is_ip(addr) and self.__resolved.get(addr, (None, 0))[1] <= now]
+
+    def __on_resolved(self, name: str, ip: Optional[str]):
+        if ip is None:
+            # keep the previous address, but retry soon
+            self.__resolved[name] = (self.__resolved.get(name, (None, 0))[0], monotonic() + min(30, self.__resolve_ttl_sec))
+        else:
+            self.__resolved[name] = (ip, monotonic() + self.__resolve_ttl_sec)
+
+    def __addrs_by_ip(self, addrs: Iterable[str]) -> Dict[str, List[str]]:
+        addrs_by_ip: Dict[str, List[str]] = dict()
+        for addr in set(addrs):
+            ip = addr if _is_ip(addr) else self.__resolved.get(addr, (None, 0))[0]
+            if ip is not None:
+                addrs_by_ip.setdefault(ip, []).append(addr)
+        return addrs_by_ip
+
+    def __recently_confirmed(self, addrs: Iterable[str], max_age_sec: float) -> Dict[str, float]:
+        if self.__neighbors is None:
+            return {}
+        ages = self.__neighbors.confirmed_age()
+        return {addr: 0.0 for addr in addrs if ages.get(addr, max_age_sec) < max_age_sec}
+
+    def __on_link(self, addrs: Iterable[str]) -> Set[str]:
+        # the TCP answer of a host behind a router may come from a firewall or proxy in between
+        if self.__neighbors is None:
+            return set()
+        return self.__neighbors.on_link(addrs)
+
+    def __icmp_prober(self) -> Optional[IcmpProber]:
+        with self.__lock:
+            if self.__icmp is None and self.__is_icmp_permitted:
+                try:
+                    self.__icmp = IcmpProber()
+                except OSError as e:
+                    logging.warning("ICMP not permitted. ICMP signal disabled " + str(e))
+                    self.__is_icmp_permitted = False
+            return self.__icmp
+
+    def ping(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        deadline = monotonic() + timeout
+        for name in self.__expired_names(addrs):
+            try:
+                self.__on_resolved(name, socket.gethostbyname(name))
+            except OSError as e:
+                logging.debug("could not resolve " + name + " " + str(e))
+                self.__on_resolved(name, None)
+        addrs_by_ip = self.__addrs_by_ip(addrs)
+
+        unanswered = set(addrs_by_ip.keys())
+        rtts = self.__recently_confirmed(unanswered, self.__neighbor_max_age_sec)
+        PROBE_SIGNALS.inc("arp", amount=len(rtts))
+        unanswered.difference_update(rtts.keys())
+
+        on_link = self.__on_link(unanswered) if unanswered else set()
+        if on_link:
+            start = monotonic()
+            answered = self.__tcp.ping(on_link, min(self.__tcp_timeout_sec, timeout))
+            PROBE_SIGNALS.inc("tcp", amount=len(answered))
+            unanswered.difference_update(answered.keys())
+            on_link.difference_update(answered.keys())
+            rtts.update(answered)
+            if on_link:
+                answered = self.__recently_confirmed(on_link, monotonic() - start)
+                PROBE_SIGNALS.inc("arp", amount=len(answered))
+                unanswered.difference_update(answered.keys())
+                rtts.update(answered)
+
+        icmp = self.__icmp_prober() if unanswered else None
+        if icmp is not None and deadline > monotonic():
+            answered = icmp.ping(unanswered, deadline - monotonic())
+            PROBE_SIGNALS.inc("icmp", amount=len(answered))
+            rtts.update(answered)
+        return {addr: rtt for ip, rtt in rtts.items() for addr in addrs_by_ip[ip]}
+
+    async def ping_async(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        loop = asyncio.get_running_loop()
+        deadline = monotonic() + timeout
+        names = self.__expired_names(addrs)
+        results = await asyncio.gather(*[loop.getaddrinfo(name, None, family=socket.AF_INET) for name in names], return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception) or not result:
+                logging.debug("could not resolve " + name + " " + str(result))
+                self.__on_resolved(name, None)
+            else:
+                self.__on_resolved(name, result[0][4][0])
+        addrs_by_ip = self.__addrs_by_ip(addrs)
+
+        unanswered = set(addrs_by_ip.keys())
+        rtts = self.__recently_confirmed(unanswered, self.__neighbor_max_age_sec)
+        PROBE_SIGNALS.inc("arp", amount=len(rtts))
+        unanswered.difference_update(rtts.keys())
+
+        on_link = self.__on_link(unanswered) if unanswered else set()
+        if on_link:
+            start = monotonic()
+            answered = await self.__tcp.ping_async(on_link, min(self.__tcp_timeout_sec, timeout))
+            PROBE_SIGNALS.inc("tcp", amount=len(answered))
+            unanswered.difference_update(answered.keys())
+            on_link.difference_update(answered.keys())
+            rtts.update(answered)
+            if on_link:
+                answered = self.__recently_confirmed(on_link, monotonic() - start)
+                PROBE_SIGNALS.inc("arp", amount=len(answered))
+                unanswered.difference_update(answered.keys())
+                rtts.update(answered)
+
+        icmp = self.__icmp_prober() if unanswered else None
+        if icmp is not None and deadline > monotonic():
+            answered = await icmp.ping_async(unanswered, deadline - monotonic())
+            PROBE_SIGNALS.inc("icmp", amount=len(answered))
+            rtts.update(answered)
+        return {addr: rtt for ip, rtt in rtts.items() for addr in addrs_by_ip[ip]}
+
+
+class ProbePolicy:
+    """
+    A probe step sends a single probe per host, which is answered within probe_timeout_sec or considered lost.
+    A host stops being probed as soon as it answers. Unanswered hosts are retried one after another by the
+    following steps, up to max_probes per round, unless they did not answer the previous round (or were never
+    seen). In this case absent_max_probes applies
+    """
+
+    def __init__(self, max_probes: int = 5, probe_timeout_sec: float = 3, absent_max_probes: int = 2):
+        self.max_probes = max_probes
+        self.probe_timeout_sec = probe_timeout_sec
+        self.absent_max_probes = absent_max_probes
+
+    def probes(self, is_answering: bool) -> int:
+        return self.max_probes if is_answering else self.absent_max_probes
+
+
+class ProbeSchedule:
+    """
+    Computes when a target is probed next. Present targets are probed every present_interval_sec. Targets
+    which stopped answering but are not absent yet are probed every boundary_interval_sec to settle their
+    state before the absence timeout expires. Absent targets are probed with exponential backoff, starting
+    with absent_interval_sec up to max_interval_sec. All intervals are randomized by +/- jitter.
+    In total, at most max_probes_per_sec echo requests are sent
+    """
+
+    def __init__(self,
+                 present_interval_sec: float = 20,
+                 boundary_interval_sec: float = 5,
+                 absent_interval_sec: float = 5,
+                 max_interval_sec: float = 60,
+                 jitter: float = 0.1,
+                 max_probes_per_sec: float = 50):
+        self.present_interval_sec = present_interval_sec
+        self.boundary_interval_sec = boundary_interval_sec
+        self.absent_interval_sec = absent_interval_sec
+        self.max_interval_sec = max_interval_sec
+        self.jitter = jitter
+        self.max_probes_per_sec = max_probes_per_sec
+
+    def interval(self, age_sec: float, timeout_sec: float, absent_misses: int) -> float:
+        if age_sec < self.present_interval_sec * 1.5:
+            interval = self.present_interval_sec
+        elif age_sec < timeout_sec:
+            interval = self.boundary_interval_sec
+        else:
+            interval = min(self.max_interval_sec, self.absent_interval_sec * 2 ** min(absent_misses, 16))
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+class RateLimiter:
+    """
+    token bucket. acquire() blocks until the requested tokens are available
+    """
+
+    def __init__(self, rate_per_sec: float):
+        self.__rate_per_sec = rate_per_sec
+        self.__tokens = rate_per_sec
+        self.__last_refill = monotonic()
+        self.__lock = Lock()
+
+    @property
+    def burst(self) -> int:
+        return max(1, int(self.__rate_per_sec))
+
+    def reserve(self, tokens: int) -> float:
+        """
+        takes the tokens and returns the time to wait before they may be used
+        """
+        with self.__lock:
+            now = monotonic()
+            self.__tokens = min(self.__rate_per_sec, self.__tokens + (now - self.__last_refill) * self.__rate_per_sec)
+            self.__last_refill = now
+            self.__tokens -= tokens
+            return -self.__tokens / self.__rate_per_sec if self.__tokens < 0 else 0
+
+    def acquire(self, tokens: int):
+        wait_sec = self.reserve(tokens)
+        if wait_sec > 0:
+            sleep(wait_sec)
+
+
+class ProbeEngine:
+    """
+    Probes all registered targets in shared batches from a single thread (or within an event loop, see
+    run_on). The targets are kept in a priority queue ordered by their next due time, which is computed
+    by the ProbeSchedule. A batch of due targets is probed by a step, which sends a single probe per
+    target. Up to max_steps steps run concurrently, so that a step waiting for the timeout of absent hosts
+    does not delay the other due targets. Unanswered targets with remaining probes are queued again.
+    A target provides an `addr`, `age_sec`, `timeout_sec`, an `is_answering` flag and an `on_probe_result(rtt)` callback
+    """
+
+    def __init__(self, prober: Prober = None, policy: ProbePolicy = None, schedule: ProbeSchedule = None, max_steps: int = 4):
+        self.__prober = prober
+        self.policy = ProbePolicy() if policy is None else policy
+        self.schedule = ProbeSchedule() if schedule is None else schedule
+        self.__rate_limiter = RateLimiter(self.schedule.max_probes_per_sec)
+        self.__lock = Lock()
+        self.__wakeup = Event()
+        self.__queue: List[Tuple[float, int, object]] = []    # heap of (due time (monotonic), seq, target)
+        self.__seq = 0
+        self.__due: Dict[object, float] = dict()             # target -> due time of its valid queue entry
+        self.__probes_left: Dict[object, int] = dict()       # target -> remaining probes of its current round
+        self.__absent_misses: Dict[object, int] = dict()     # registered target -> unanswered rounds since absent
+        self.__is_running = False
+        self.__max_steps = max_steps
+        self.__free_steps = Semaphore(max_steps)
+        self.__steps: Queue = Queue()
+        self.__active_steps = 0
+        self.__step_workers = 0                              # started on demand, up to max_steps
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.__async_wakeup = asyncio.Event()
+        self.__step_tasks: Set[asyncio.Task] = set()
+
+    @property
+    def prober(self) -> Prober:
+        with self.__lock:
+            if self.__prober is None:
+                self.__prober = MultiSignalProber()
+            return self.__prober
+
+    def __schedule(self, target, due: float):
+        # requires lock. Entries superseded by a newer one are skipped on pop
+        self.__seq += 1
+        self.__due[target] = due
+        heapq.heappush(self.__queue, (due, self.__seq, target))
+
+    def register(self, target):
+        with self.__lock:
+            self.__absent_misses[target] = -1
+            self.__probes_left.pop(target, None)
+            self.__schedule(target, monotonic())
+            if not self.__is_running:
+                self.__is_running = True
+                Thread(target=self.__probe_loop, daemon=True).start()
+        self.__wake_up()
+
+    def unregister(self, target):
+        with self.__lock:
+            self.__due.pop(target, None)
+            self.__probes_left.pop(target, None)
+            self.__absent_misses.pop(target, None)
+
+    def run_on(self, loop: asyncio.AbstractEventLoop):
+        """
+        probes within the given event loop instead of an own thread. Must be called before any target is registered
+        """
+        with self.__lock:
+            self.__loop = loop
+            self.__is_running = True
+        loop.call_soon_threadsafe(loop.create_task, self.__probe_loop_async())
+
+    def stop(self):
+        self.__is_running = False
+        self.__wake_up()
+
+    def __wake_up(self):
+        if self.__loop is None:
+            self.__wakeup.set()
+        else:
+            self.__loop.call_soon_threadsafe(self.__async_wakeup.set)
+
+    def __next_due_targets(self) -> Tuple[List, float]:
+        # returns the due targets (limited to the rate limiter's burst) and the time to wait for the next one
+        now = monotonic()
+        due = []
+        with self.__lock:
+            while self.__queue and len(due) < self.__rate_limiter.burst:
+                due_time, _, target = self.__queue[0]
+                if self.__due.get(target, None) != due_time:
+                    heapq.heappop(self.__queue)       # superseded or unregistered
+                elif due_time <= now:
+                    heapq.heappop(self.__queue)
+                    del self.__due[target]
+                    if target not in self.__probes_left:
+                        self.__probes_left[target] = self.policy.probes(target.is_answering)
+                    due.append(target)
+                    PROBE_LOOP_LAG.observe(now - due_time)
+                else:
+                    break
+            wait_sec = (self.__queue[0][0] - now) if self.__queue else 1
+        return due, wait_sec
+
+    def __probe_loop(self):
+        while self.__is_running:
+            try:
+                if not self.__free_steps.acquire(timeout=1):
+                    continue
+                due, wait_sec = self.__next_due_targets()
+                if due:
+                    addrs = {target.addr for target in due}
+                    self.__rate_limiter.acquire(len(addrs))
+                    self.__submit(due, addrs)
+                else:
+                    self.__free_steps.release()
+                    self.__wakeup.wait(min(wait_sec, 1))
+                    self.__wakeup.clear()
+            except Exception as e:
+                logging.warning(e, exc_info=True)
+                sleep(3)
+
+    def __submit(self, due: List, addrs: Set[str]):
+        with self.__lock:
+            self.__active_steps += 1
+            if self.__active_steps > self.__step_workers:
+                self.__step_workers += 1
+                Thread(target=self.__step_loop, name="probe-step-" + str(self.__step_workers), daemon=True).start()
+        self.__steps.put((due, addrs))
+
+    def __step_loop(self):
+        while True:
+            due, addrs = self.__steps.get()
+            rtts: Dict[str, float] = dict()
+            start = monotonic()
+            try:
+                rtts = self.prober.ping(addrs, self.policy.probe_timeout_sec)
+            except Exception as e:
+                logging.warning(e, exc_info=True)
+            finally:
+                with self.__lock:
+                    self.__active_steps -= 1
+                self.__free_steps.release()
+            self.__on_step(due, addrs, rtts, monotonic() - start)
+
+    async def __probe_loop_async(self):
+        free_steps = asyncio.Semaphore(self.__max_steps)
+        while self.__is_running:
+            try:
+                await free_steps.acquire()
+                due, wait_sec = self.__next_due_targets()
+                if due:
+                    addrs = {target.addr for target in due}
+                    rate_limit_sec = self.__rate_limiter.reserve(len(addrs))
+                    if rate_limit_sec > 0:
+                        await asyncio.sleep(rate_limit_sec)
+                    task = self.__loop.create_task(self.__step_async(due, addrs, free_steps))
+                    self.__step_tasks.add(task)
+                    task.add_done_callback(self.__step_tasks.discard)
+                else:
+                    free_steps.release()
+                    try:
+                        await asyncio.wait_for(self.__async_wakeup.wait(), min(wait_sec, 1))
+                    except asyncio.TimeoutError:
+                        pass
+                    self.__async_wakeup.clear()
+            except Exception as e:
+                logging.warning(e, exc_info=True)
+                await asyncio.sleep(3)
+
+    async def __step_async(self, due: List, addrs: Set[str], free_steps: asyncio.Semaphore):
+        rtts: Dict[str, float] = dict()
+        start = monotonic()
+        try:
+            rtts = await self.prober.ping_async(addrs, self.policy.probe_timeout_sec)
+        except Exception as e:
+            logging.warning(e, exc_info=True)
+        finally:
+            free_steps.release()
+        self.__on_step(due, addrs, rtts, monotonic() - start)
+
+    def __on_step(self, due: List, addrs: Set[str], rtts: Dict[str, float], elapsed_sec: float):
+        PROBE_STEP.observe(elapsed_sec)
+        for addr in addrs:
+            PROBES.inc(addr)
+        for addr, rtt in rtts.items():
+            PROBE_REPLIES.inc(addr)
+            PROBE_RTT.observe(rtt, addr)
+        for target in due:
+            rtt = rtts.get(target.addr, None)
+            with self.__lock:
+                probes_left = self.__probes_left.pop(target, 0) - 1
+                if rtt is None and probes_left > 0 and target in self.__absent_misses:
+                    # the probe timeout is already elapsed. Retry with the next step
+                    self.__probes_left[target] = probes_left
+                    self.__schedule(target, monotonic())
+                    continue
+            try:
+                self.__report(target, rtt)
+            except Exception as e:
+                logging.warning(e, exc_info=True)
+        # the targets may be due before the time the probe loop is waiting for (e.g. retries)
+        self.__wake_up()
+
+    def __report(self, target, rtt: Optional[float]):
+        target.on_probe_result(rtt)
+        age_sec = target.age_sec
+        with self.__lock:
+            if target not in self.__absent_misses:
+                return     # unregistered in the meantime
+            if rtt is None and age_sec >= target.timeout_sec:
+                absent_misses = self.__absent_misses[target] + 1
+            else:
+                absent_misses = -1
+            self.__absent_misses[target] = absent_misses
+            self.__schedule(target, monotonic() + self.schedule.interval(age_sec, target.timeout_sec, max(0, absent_misses)))
+
+
+_default_engine = None
+_default_engine_lock = Lock()
+
+
+def default_probe_engine() -> ProbeEngine:
+    global _default_engine
+    with _default_engine_lock:
+        if _default_engine is None:
+            _default_engine = ProbeEngine()
+        return _default_engine
@@ -0,0 +1,127 @@
+import logging
+from time import time, monotonic
+from threading import Lock, Condition
+from datetime import datetime
+from typing import List, NamedTuple, Tuple, Dict, Optional, Set
+from presence import Presence, LISTENER_FANOUT, from_ts
+
+
+class PresenceState(NamedTuple):
+    name: str
+    addr: str
+    is_known: bool                      # false, as long as the presence state has not been determined
+    is_presence: bool
+    last_seen_ts: float                 # UTC epoch seconds
+
+    @property
+    def last_seen(self) -> datetime:
+        # UTC
+        return from_ts(self.last_seen_ts)
+
+    @property
+    def last_seen_str(self) -> str:
+        # ISO8601 UTC, minute precision
+        return self.last_seen.strftime("%Y-%m-%dT%H:%M")
+
+    @property
+    def status(self) -> str:
+        if self.is_known:
+            return "present" if self.is_presence else "absent"
+        else:
+            return "unknown"
+
+    @property
+    def age_sec(self) -> int:
+        return int(time() - self.last_seen_ts)
+
+    @staticmethod
+    def of(presence: Presence):
+        return PresenceState(presence.name, presence.addr, presence.is_known, presence.is_presence, presence.last_seen_ts)
+
+    def is_same(self, other) -> bool:
+        return other is not None and self.status == other.status and self.last_seen_ts // 60 == other.last_seen_ts // 60
+
+
+class PresenceSnapshot(NamedTuple):
+    version: int
+    names: Tuple[str, ...]              # the same tuple instance as long as the device set is unchanged
+    states: Tuple[PresenceState, ...]
+    by_name: Dict[str, PresenceState]
+
+    @staticmethod
+    def of(version: int, names: Tuple[str, ...], states: Tuple[PresenceState, ...]):
+        return PresenceSnapshot(version, names, states, {state.name: state for state in states})
+
+
+class PresenceRegistry:
+    """
+    Holds the presences served by the webthing, HTTP and MCP servers. Readers get an immutable
+    PresenceSnapshot which is replaced (with an incremented version) only if the published state
+    (presence flag or the minute of last seen) of a presence changes
+    """
+
+    def __init__(self, presences: List[Presence]):
+        self.presences = presences
+        self.__lock = Lock()
+        self.__changed = Condition(self.__lock)
+        self.__listeners: Dict[Optional[str], Set] = dict()      # presence name (None for all) -> listeners
+        self.__index = {presence.name: idx for idx, presence in enumerate(presences)}
+        self.snapshot = PresenceSnapshot.of(1, tuple(presence.name for presence in presences), tuple(PresenceState.of(presence) for presence in presences))
+        [presence.add_listener(self.__on_value_changed, heartbeat=True) for presence in presences]
+
+    def update(self, presences: List[Presence]):
+        """
+        replaces the set of presences (e.g. on reloading the device configuration). Listeners are notified
+        about the added and removed presences
+        """
+        with self.__lock:
+            current, new = set(self.presences), set(presences)
+            added = [presence for presence in presences if presence not in current]
+            removed = [presence for presence in self.presences if presence not in new]
+            [presence.remove_listener(self.__on_value_changed, heartbeat=True) for presence in removed]
+            [presence.add_listener(self.__on_value_changed, heartbeat=True) for presence in added]
+            snapshot = self.snapshot
+            self.presences = list(presences)
+            self.__index = {presence.name: idx for idx, presence in enumerate(self.presences)}
+            self.snapshot = PresenceSnapshot.of(snapshot.version + 1,
+                                                tuple(presence.name for presence in self.presences),
+                                                tuple(snapshot.by_name[presence.name] if presence in current else PresenceState.of(presence) for presence in self.presences))
+            self.__changed.notify_all()
+        self.__notify([presence.name for presence in added + removed])
+
+    def add_listener(self, listener, name: str = None):
+        """
+        listeners are called only if a new snapshot has been published, i.e. the published state has changed
+        """
+        self.__listeners.setdefault(name, set()).add(listener)
+
+    def wait_for_change(self, version: int, timeout_sec: float) -> PresenceSnapshot:
+        """
+        blocks until the snapshot differs from the given version or the timeout is reached
+        """
+        with self.__lock:
+            self.__changed.wait_for(lambda: self.snapshot.version != version, timeout_sec)
+            return self.snapshot
+
+    def __on_value_changed(self, name: str):
+        with self.__lock:
+            snapshot = self.snapshot
+            idx = self.__index.get(name, None)
+            if idx is None:
+                return
+            new_state = PresenceState.of(self.presences[idx])
+            if new_state.is_same(snapshot.states[idx]):
+                return
+            self.snapshot = PresenceSnapshot.of(snapshot.version + 1, snapshot.names, snapshot.states[:idx] + (new_state,) + snapshot.states[idx+1:])
+            self.__changed.notify_all()
+        self.__notify([name])
+
+    def __notify(self, names: List[str]):
+        start = monotonic()
+        for name in names:
+            for listener in self.__listeners.get(None, set()) | self.__listeners.get(name, set()):
+                try:
+                    listener(name)
+                except Exception as e:
+                    logging.warning("error occurred on notifying " + str(e), exc_info=True)
+        LISTENER_FANOUT.observe(monotonic() - start, "snapshot")
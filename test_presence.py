@@ -0,0 +1,388 @@
+import asyncio
+import threading
+import pytest
+from time import monotonic, sleep, time
+from typing import Dict, Iterable, List, Set
+from datetime import datetime
+from presence import Presence, Presences, from_ts, NEVER_SEC
+from probe import ProbeEngine, ProbePolicy, ProbeSchedule
+from presence_webthing import PresenceSet
+
+
+def wait_until(condition, timeout_sec: float = 5) -> bool:
+    deadline = monotonic() + timeout_sec
+    while not condition():
+        if monotonic() > deadline:
+            return False
+        sleep(0.01)
+    return True
+
+
+class FakeProber:
+    """
+    answers the addresses of the answering set immediately and records the probed batches
+    """
+
+    def __init__(self, answering: Iterable[str] = ()):
+        self.answering = set(answering)
+        self.batches: List[Set[str]] = []
+        self.lock = threading.Lock()
+
+    def ping(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        addrs = set(addrs)
+        with self.lock:
+            self.batches.append(addrs)
+        return {addr: 0.001 for addr in addrs if addr in self.answering}
+
+    async def ping_async(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        return self.ping(addrs, timeout)
+
+    def probes(self, addr: str) -> int:
+        with self.lock:
+            return sum(1 for batch in self.batches if addr in batch)
+
+
+class BlockingProber(FakeProber):
+    """
+    blocks the batches containing the blocked address until released
+    """
+
+    def __init__(self, blocked: str, answering: Iterable[str] = ()):
+        super().__init__(answering)
+        self.blocked = blocked
+        self.entered = threading.Event()
+        self.released = threading.Event()
+
+    def ping(self, addrs: Iterable[str], timeout: float = 3) -> Dict[str, float]:
+        addrs = set(addrs)
+        if self.blocked in addrs:
+            self.entered.set()
+            self.released.wait(5)
+        return super().ping(addrs, timeout)
+
+
+class Target:
+    """
+    the probe target interface of the ProbeEngine, as provided by IpPresence
+    """
+
+    def __init__(self, addr: str, is_answering: bool = False, age_sec: float = NEVER_SEC, timeout_sec: int = 60):
+        self.addr = addr
+        self.is_answering = is_answering
+        self.age_sec = age_sec
+        self.timeout_sec = timeout_sec
+        self.results: List = []
+
+    def on_probe_result(self, rtt):
+        if rtt is not None:
+            self.age_sec = 0
+            self.is_answering = True
+        else:
+            self.is_answering = False
+        self.results.append(rtt)
+
+
+class RecordingSchedule(ProbeSchedule):
+
+    def __init__(self, interval_sec: float, **kwargs):
+        super().__init__(**kwargs)
+        self.interval_sec = interval_sec
+        self.absent_misses: List[int] = []
+
+    def interval(self, age_sec: float, timeout_sec: float, absent_misses: int) -> float:
+        self.absent_misses.append(absent_misses)
+        return self.interval_sec
+
+
+def single_round_schedule(max_probes_per_sec: float = 1000) -> ProbeSchedule:
+    # the next round is out of the test time
+    return ProbeSchedule(present_interval_sec=60, boundary_interval_sec=60, absent_interval_sec=60, max_interval_sec=60, jitter=0, max_probes_per_sec=max_probes_per_sec)
+
+
+@pytest.fixture
+def engines():
+    created: List[ProbeEngine] = []
+    yield created
+    [engine.stop() for engine in created]
+
+
+def test_retries_of_answering_and_never_seen_targets(engines):
+    prober = FakeProber(answering=["10.0.0.3"])
+    engine = ProbeEngine(prober, ProbePolicy(max_probes=5, absent_max_probes=2), single_round_schedule())
+    engines.append(engine)
+    silent = Target("10.0.0.1", is_answering=True, age_sec=10)
+    never_seen = Target("10.0.0.2")
+    answering = Target("10.0.0.3", is_answering=True, age_sec=10)
+    [engine.register(target) for target in (silent, never_seen, answering)]
+
+    assert wait_until(lambda: all(target.results for target in (silent, never_seen, answering)))
+    sleep(0.1)
+    assert prober.probes("10.0.0.1") == 5
+    assert prober.probes("10.0.0.2") == 2
+    assert prober.probes("10.0.0.3") == 1
+    assert silent.results == [None]
+    assert never_seen.results == [None]
+    assert answering.results == [0.001]
+
+
+def test_step_sends_single_probe_per_target(engines):
+    prober = FakeProber()
+    engine = ProbeEngine(prober, ProbePolicy(max_probes=3, absent_max_probes=3), single_round_schedule())
+    engines.append(engine)
+    targets = [Target("10.0.1." + str(i), is_answering=True, age_sec=10) for i in range(10)]
+    [engine.register(target) for target in targets]
+
+    assert wait_until(lambda: all(target.results for target in targets))
+    assert all(len(batch) == len(set(batch)) for batch in prober.batches)
+    assert all(prober.probes(target.addr) == 3 for target in targets)
+
+
+def test_absent_backoff():
+    schedule = ProbeSchedule(absent_interval_sec=5, max_interval_sec=60, jitter=0)
+    assert [schedule.interval(100, 60, misses) for misses in range(6)] == [5, 10, 20, 40, 60, 60]
+    assert schedule.interval(0, 60, 3) == schedule.present_interval_sec
+    assert schedule.interval(40, 60, 3) == schedule.boundary_interval_sec
+
+
+def test_absent_misses_grow_until_answered(engines):
+    prober = FakeProber()
+    schedule = RecordingSchedule(0.01)
+    engine = ProbeEngine(prober, ProbePolicy(max_probes=1, absent_max_probes=1), schedule)
+    engines.append(engine)
+    target = Target("10.0.0.1")
+    engine.register(target)
+
+    assert wait_until(lambda: len(schedule.absent_misses) >= 4)
+    assert schedule.absent_misses[:4] == [0, 1, 2, 3]
+
+    prober.answering.add(target.addr)
+    assert wait_until(lambda: target.results[-1] is not None)
+    answered = target.results.index(0.001)
+    # a present target is scheduled without backoff
+    assert wait_until(lambda: len(schedule.absent_misses) > answered)
+    assert schedule.absent_misses[answered] == 0
+
+
+def test_unregister_during_step(engines):
+    prober = BlockingProber("10.0.0.1")
+    engine = ProbeEngine(prober, ProbePolicy(max_probes=5, absent_max_probes=5), single_round_schedule(), max_steps=1)
+    engines.append(engine)
+    target = Target("10.0.0.1")
+    engine.register(target)
+
+    assert prober.entered.wait(5)
+    engine.unregister(target)
+    prober.released.set()
+    sleep(0.3)
+    # the unanswered target is neither retried nor scheduled again
+    assert prober.probes(target.addr) == 1
+    assert len(target.results) <= 1
+
+
+def test_reregistered_target_is_probed_once(engines):
+    prober = BlockingProber("10.0.0.1", answering=["10.0.0.2"])
+    engine = ProbeEngine(prober, ProbePolicy(), single_round_schedule(), max_steps=1)
+    engines.append(engine)
+    engine.register(Target("10.0.0.1", is_answering=True, age_sec=10))
+    assert prober.entered.wait(5)
+
+    # the second registration supersedes the queue entry of the first one
+    target = Target("10.0.0.2", is_answering=True, age_sec=10)
+    engine.register(target)
+    engine.register(target)
+    prober.released.set()
+
+    assert wait_until(lambda: target.results)
+    sleep(0.2)
+    assert prober.probes(target.addr) == 1
+    assert target.results == [0.001]
+
+
+def test_rate_limit_batches(engines):
+    addrs = ["10.0.2." + str(i) for i in range(12)]
+    prober = FakeProber(answering=addrs)
+    engine = ProbeEngine(prober, ProbePolicy(), single_round_schedule(max_probes_per_sec=5))
+    engines.append(engine)
+    targets = [Target(addr, is_answering=True, age_sec=10) for addr in addrs]
+    start = monotonic()
+    [engine.register(target) for target in targets]
+
+    assert wait_until(lambda: all(target.results for target in targets))
+    # the burst is a second of the rate. 12 probes require 2 further seconds of tokens beyond the first burst
+    assert monotonic() - start >= 1.2
+    assert max(len(batch) for batch in prober.batches) <= 5
+    assert all(prober.probes(addr) == 1 for addr in addrs)
+
+
+def test_probe_within_event_loop():
+    prober = FakeProber(answering=["10.0.0.1"])
+    engine = ProbeEngine(prober, ProbePolicy(max_probes=5, absent_max_probes=2), single_round_schedule())
+    target = Target("10.0.0.1", is_answering=True, age_sec=10)
+    never_seen = Target("10.0.0.2")
+
+    async def run():
+        engine.run_on(asyncio.get_running_loop())
+        engine.register(target)
+        engine.register(never_seen)
+        deadline = monotonic() + 5
+        while not (target.results and never_seen.results) and monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        engine.stop()
+
+    asyncio.run(run())
+    assert target.results == [0.001]
+    assert never_seen.results == [None]
+    assert prober.probes("10.0.0.2") == 2
+
+
+class FakePresence(Presence):
+
+    def __init__(self, name: str, age_sec: float = NEVER_SEC, is_known: bool = True, timeout_sec: int = 60):
+        self.ts = time() - age_sec
+        self.known = is_known
+        super().__init__(name, "", timeout_sec)
+
+    @property
+    def last_time_presence(self) -> datetime:
+        return from_ts(self.ts)
+
+    @property
+    def last_seen_ts(self) -> float:
+        return self.ts
+
+    @property
+    def is_known(self) -> bool:
+        return self.known
+
+    def seen(self, age_sec: float):
+        self.ts = time() - age_sec
+        self.known = True
+        self._notify_listeners(self.name)
+
+
+def transitions_of(presence: Presence) -> List:
+    transitions = []
+    presence.add_listener(lambda name: transitions.append(presence.is_presence if presence.is_known else None))
+    return transitions
+
+
+def test_any_group():
+    alice, bob = FakePresence("alice", age_sec=0), FakePresence("bob", age_sec=100)
+    group = Presences("home", [alice, bob], 60, "any")
+    transitions = transitions_of(group)
+    assert group.is_known and group.is_presence
+
+    bob.seen(0)
+    assert group.is_presence and transitions == []
+    alice.seen(100)
+    assert group.is_presence and transitions == []
+    # the member holding the aggregate leaves. The members are rescanned
+    bob.seen(90)
+    assert not group.is_presence
+    assert transitions == [False]
+    assert abs(group.age_sec - 90) <= 1
+    alice.seen(0)
+    assert transitions == [False, True]
+    group.stop()
+
+
+def test_all_group():
+    alice, bob = FakePresence("alice", age_sec=0), FakePresence("bob", age_sec=0)
+    group = Presences("home", [alice, bob], 60, "all")
+    transitions = transitions_of(group)
+    assert group.is_known and group.is_presence
+
+    bob.seen(100)
+    assert not group.is_presence and transitions == [False]
+    bob.seen(0)
+    assert group.is_presence and transitions == [False, True]
+    group.stop()
+
+
+def test_all_group_with_unknown_members():
+    alice, bob = FakePresence("alice", is_known=False), FakePresence("bob", age_sec=100)
+    group = Presences("home", [alice, bob], 60, "all")
+    # an absent member makes the group absent, no matter if other members are unknown
+    assert group.is_known and not group.is_presence
+
+    bob.seen(0)
+    assert not group.is_known
+    alice.seen(0)
+    assert group.is_known and group.is_presence
+    group.stop()
+
+
+def test_all_group_of_unknown_members():
+    alice, bob = FakePresence("alice", is_known=False), FakePresence("bob", is_known=False)
+    group = Presences("home", [alice, bob], 60, "all")
+    assert not group.is_known
+
+    alice.seen(0)
+    assert not group.is_known
+    bob.seen(100)
+    assert group.is_known and not group.is_presence
+    group.stop()
+
+
+def test_any_group_with_unknown_members():
+    alice, bob = FakePresence("alice", is_known=False), FakePresence("bob", age_sec=100)
+    group = Presences("home", [alice, bob], 60, "any")
+    assert not group.is_known
+
+    alice.seen(0)
+    assert group.is_known and group.is_presence
+    group.stop()
+
+
+def test_group_members_are_replaced():
+    alice, bob, carol = FakePresence("alice", age_sec=100), FakePresence("bob", age_sec=100), FakePresence("carol", age_sec=0)
+    group = Presences("home", [alice, bob], 60, "any")
+    assert not group.is_presence
+
+    group.set_members([alice, carol])
+    assert group.is_presence
+    # removed members are not observed anymore
+    bob.seen(0)
+    carol.seen(100)
+    assert not group.is_presence
+    group.stop()
+
+
+def names(presences: List[Presence]) -> List[str]:
+    return sorted(presence.name for presence in presences)
+
+
+def test_presence_set_load():
+    presence_set = PresenceSet(60)
+    added, removed = presence_set.load({"alice": "10.0.0.1", "bob": "10.0.0.2"})
+    assert names(added) == ["alice", "any", "bob"]
+    assert removed == []
+    alice, bob, group = [{presence.name: presence for presence in added}[name] for name in ("alice", "bob", "any")]
+    assert group.members == [alice, bob]
+
+    added, removed = presence_set.load({"alice": "10.0.0.1", "bob": "10.0.0.3", "carol": "10.0.0.4"})
+    assert names(added) == ["bob", "carol"]
+    assert removed == [bob]
+    by_name = {presence.name: presence for presence in presence_set.presences}
+    # unchanged devices and groups are kept
+    assert by_name["alice"] is alice
+    assert by_name["any"] is group
+    assert group.members == [alice, by_name["bob"], by_name["carol"]]
+
+    added, removed = presence_set.load({"alice": "10.0.0.1", "bob": "10.0.0.3", "home": "all(alice,bob)"})
+    assert names(added) == ["home"]
+    assert names(removed) == ["any", "carol"]
+    assert names(presence_set.presences) == ["alice", "bob", "home"]
+    [presence.stop() for presence in presence_set.presences]
+
+
+def test_presence_set_rejects_invalid_config():
+    presence_set = PresenceSet(60)
+    presence_set.load({"alice": "10.0.0.1", "bob": "10.0.0.2"})
+    presences = list(presence_set.presences)
+    with pytest.raises(ValueError):
+        presence_set.load({"alice": "10.0.0.1", "home": "any(alice,home)"})
+    with pytest.raises(ValueError):
+        presence_set.load({"alice": "10.0.0.1", "home": "any(alice,carol)"})
+    assert presence_set.presences == presences
+    [presence.stop() for presence in presence_set.presences]